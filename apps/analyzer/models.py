@@ -1,7 +1,14 @@
 import mongoengine as mongo
+from collections import defaultdict
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from apps.rss_feeds.models import Feed, StoryAuthor, Tag
+from utils.aho_corasick import PhraseMatcher
+
+# Bundles with more classifiers than this are rebuilt on each use instead
+# of cached, since memcached silently refuses items over 1MB.
+MAX_CACHED_CLASSIFIERS = 500
 
 class FeatureCategory(models.Model):
     user = models.ForeignKey(User)
@@ -156,7 +163,123 @@ def apply_classifier_tags(classifiers, story):
             return classifier.score
     return 0
     
+class ClassifierMatcher(object):
+    """
+    A user's classifiers for one feed, compiled to score a story in a single
+    pass: title phrases go into one Aho-Corasick automaton, and authors and
+    tags into dicts. Scores are the same as the apply_classifier_* functions
+    give, including the first classifier winning when several match.
+    """
+    def __init__(self, feed_id, classifier_feeds=(), classifier_authors=(), 
+                 classifier_titles=(), classifier_tags=()):
+        classifier_feeds = list(classifier_feeds)
+        classifier_authors = list(classifier_authors)
+        classifier_titles = list(classifier_titles)
+        classifier_tags = list(classifier_tags)
+        
+        self.feed_id = feed_id
+        self.trained = bool(classifier_feeds or classifier_authors or 
+                            classifier_titles or classifier_tags)
+        self.feed_score = 0
+        for classifier in classifier_feeds:
+            if classifier.feed_id == feed_id:
+                self.feed_score = classifier.score
+                break
+        self.authors = {}
+        for classifier in classifier_authors:
+            self.authors.setdefault(classifier.author, classifier.score)
+        self.tags = {}
+        for index, classifier in enumerate(classifier_tags):
+            self.tags.setdefault(classifier.tag, (index, classifier.score))
+        self.title_scores = [classifier.score for classifier in classifier_titles]
+        self.titles = PhraseMatcher([classifier.title.lower() for classifier in classifier_titles])
+        
+        self.payload = {
+            'feeds': dict([(f.feed_id, f.score) for f in classifier_feeds]),
+            'authors': dict([(a.author, a.score) for a in classifier_authors]),
+            'titles': dict([(t.title, t.score) for t in classifier_titles]),
+            'tags': dict([(t.tag, t.score) for t in classifier_tags]),
+        }
+    
+    def score(self, story):
+        if not self.trained:
+            return dict(feed=0, author=0, tags=0, title=0)
+        
+        return {
+            'feed': self.feed_score,
+            'author': self.score_author(story),
+            'tags': self.score_tags(story),
+            'title': self.score_title(story),
+        }
+    
+    def score_author(self, story):
+        author = story.get('story_authors')
+        if author and author in self.authors:
+            return self.authors[author]
+        return 0
+    
+    def score_tags(self, story):
+        matches = [self.tags[tag] for tag in story['story_tags'] or [] if tag in self.tags]
+        if matches:
+            return min(matches)[1]
+        return 0
+    
+    def score_title(self, story):
+        if not self.title_scores:
+            return 0
+        matches = self.titles.search(story['story_title'].lower())
+        if matches:
+            return self.title_scores[min(matches)]
+        return 0
+    
+class ClassifierBundle(object):
+    """
+    All of a user's classifiers, across every feed, compiled into a
+    ClassifierMatcher per trained feed. Loaded with one query per classifier
+    type and cached whole, so views that touch many feeds don't query each.
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.size = 0
+        classifiers = defaultdict(lambda: dict(classifier_feeds=[], classifier_authors=[],
+                                               classifier_titles=[], classifier_tags=[]))
+        for classifier_type, ClassifierCls in (('classifier_feeds', MClassifierFeed),
+                                               ('classifier_authors', MClassifierAuthor),
+                                               ('classifier_titles', MClassifierTitle),
+                                               ('classifier_tags', MClassifierTag)):
+            for classifier in ClassifierCls.objects(user_id=user_id):
+                classifiers[classifier.feed_id][classifier_type].append(classifier)
+                self.size += 1
+        
+        self.matchers = dict((feed_id, ClassifierMatcher(feed_id, **feed_classifiers))
+                             for feed_id, feed_classifiers in classifiers.items())
+    
+    def matcher(self, feed_id):
+        if feed_id in self.matchers:
+            return self.matchers[feed_id]
+        return ClassifierMatcher(feed_id)
+
+def get_classifier_bundle(user_id):
+    """The user's compiled classifiers, from the cache when built already."""
+    cache_key = 'classifiers:%s' % user_id
+    bundle = cache.get(cache_key)
+    if bundle is None:
+        bundle = ClassifierBundle(user_id)
+        if bundle.size <= MAX_CACHED_CLASSIFIERS:
+            cache.set(cache_key, bundle, 60*60*24)
+    return bundle
+    
+def get_classifier_matcher(user_id, feed_id):
+    return get_classifier_bundle(user_id).matcher(feed_id)
+
+def invalidate_classifiers(user_id):
+    cache.delete('classifiers:%s' % user_id)
+    
 def get_classifiers_for_user(user, feed_id, classifier_feeds=None, classifier_authors=None, classifier_titles=None, classifier_tags=None):
+    if (classifier_feeds is None and classifier_authors is None and 
+        classifier_titles is None and classifier_tags is None):
+        return get_classifier_matcher(user.pk, feed_id).payload
+    
     if classifier_feeds is None:
         classifier_feeds = MClassifierFeed.objects(user_id=user.pk, feed_id=feed_id)
     else: classifier_feeds.rewind()
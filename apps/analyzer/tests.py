@@ -9,6 +9,9 @@ from pprint import pprint
 from apps.analyzer.tokenizer import Tokenizer
 from utils.reverend.thomas import Bayes
 from apps.analyzer.phrase_filter import PhraseFilter
+from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
+from apps.analyzer.models import ClassifierMatcher
+from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds, apply_classifier_authors, apply_classifier_tags
 
 class ClassifierTest(TestCase):
     
@@ -101,4 +104,37 @@ class ClassifierTest(TestCase):
         guess = classifier.guess('Nothing doing: 393 Pacific St.')
         self.assertTrue('bad' not in guess)
         self.assertTrue('good' not in guess)
-        
\ No newline at end of file
+        
+    
+    def test_classifier_matcher(self):
+        feed = Feed.objects.all()[0]
+        classifier_feeds = [MClassifierFeed(feed_id=feed.pk, score=-1)]
+        classifier_authors = [MClassifierAuthor(author='Bob', score=1),
+                              MClassifierAuthor(author='Bob', score=-1),
+                              MClassifierAuthor(author='Sam', score=-1)]
+        classifier_titles = [MClassifierTitle(title='of the Day', score=1),
+                             MClassifierTitle(title='development', score=-1),
+                             MClassifierTitle(title='Pacific', score=-1)]
+        classifier_tags = [MClassifierTag(tag='condos', score=-1),
+                           MClassifierTag(tag='houses', score=1)]
+        matcher = ClassifierMatcher(feed.pk, classifier_feeds, classifier_authors,
+                                    classifier_titles, classifier_tags)
+        
+        stories = [
+            dict(story_title='House of the Day: 393 Pacific St.', story_authors='Bob', 
+                 story_tags=['houses', 'condos']),
+            dict(story_title='Development Watch: 393 Pacific St. #3', story_authors='Sam',
+                 story_tags=['condos']),
+            dict(story_title='Streetlevel: 123 Carlton St.', story_authors=None, story_tags=[]),
+            dict(story_title='DEVELOPMENT of the day', story_authors='Ann', story_tags=None),
+        ]
+        for story in stories:
+            self.assertEquals(matcher.score(story), {
+                'feed': apply_classifier_feeds(classifier_feeds, feed),
+                'author': apply_classifier_authors(classifier_authors, story),
+                'tags': apply_classifier_tags(classifier_tags, story),
+                'title': apply_classifier_titles(classifier_titles, story),
+            })
+        
+        untrained = ClassifierMatcher(feed.pk)
+        self.assertEquals(untrained.score(stories[0]), dict(feed=0, author=0, tags=0, title=0))
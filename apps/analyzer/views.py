@@ -4,7 +4,7 @@ from django.views.decorators.http import require_POST
 from apps.rss_feeds.models import Feed
 from apps.reader.models import UserSubscription
 from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
-from apps.analyzer.models import get_classifiers_for_user
+from apps.analyzer.models import get_classifiers_for_user, invalidate_classifiers
 from utils import json_functions as json
 from utils.user_functions import get_user
 from utils.user_functions import ajax_login_required
@@ -70,6 +70,11 @@ def save_classifier(request):
     _save_classifier(MClassifierTag, 'tag')
     _save_classifier(MClassifierTitle, 'title')
     _save_classifier(MClassifierFeed, 'feed')
+    invalidate_classifiers(request.user.pk)
+    
+    # Scores can move in any direction, so recount the unreads once the
+    # classifiers are all saved.
+    UserSubscription.queue_recalc([usersub])
     
     logging.info(" ---> [%s] ~FGFeed training: ~SB%s" % (request.user, feed))
 
@@ -1,14 +1,25 @@
 import datetime
+import time
 import mongoengine as mongo
+import pymongo
+from collections import defaultdict
 from utils import log as logging
 from utils import json_functions as json
 from django.db import models, IntegrityError
+from django.db.models import F
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from apps.rss_feeds.models import Feed, Story, MStory, DuplicateFeed
+from apps.rss_feeds.models import Feed, Story, MStory, MStarredStory, DuplicateFeed
 from apps.analyzer.models import MClassifierFeed, MClassifierAuthor, MClassifierTag, MClassifierTitle
-from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds, apply_classifier_authors, apply_classifier_tags
+from apps.analyzer.models import ClassifierMatcher, get_classifier_matcher
+
+FEEDS_SNAPSHOT_CACHE_SECONDS = 60*60*24
+FEED_UPDATES_CACHE_SECONDS = 60*60*24
+FEED_UPDATES_POLL_SECONDS = 1
+# Unread counts calculated longer ago than this are recalculated, so that
+# stories that have aged out of the unread window stop being counted.
+UNREAD_COUNTS_MAX_AGE = datetime.timedelta(days=1)
 
 class UserSubscription(models.Model):
     """
@@ -17,6 +28,10 @@ class UserSubscription(models.Model):
     
     Also has a dirty flag (needs_unread_recalc) which means that the unread counts
     are not accurate and need to be calculated with `self.calculate_feed_scores()`.
+    Otherwise the counts are kept up to date as stories are added, read and
+    unread, with `self.update_unread_counts()`. Those deltas never age a story
+    out of the unread window, so `unread_count_updated` records the last full
+    calculation and `expire_unread_counts()` flags counts that are too old.
     """
     UNREAD_CUTOFF = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
     user = models.ForeignKey(User, related_name='subscriptions')
@@ -44,7 +59,11 @@ class UserSubscription(models.Model):
             if duplicate_feed:
                 self.feed = duplicate_feed[0].feed
                 super(UserSubscription, self).save(*args, **kwargs)
-                
+        invalidate_feeds_snapshot(self.user_id)
+    
+    def delete(self, *args, **kwargs):
+        super(UserSubscription, self).delete(*args, **kwargs)
+        invalidate_feeds_snapshot(self.user_id)
         
     def mark_feed_read(self):
         now = datetime.datetime.utcnow()
@@ -88,17 +107,10 @@ class UserSubscription(models.Model):
         else:
             self.mark_read_date = date_delta
             
-        read_stories = MUserStory.objects(user_id=self.user.pk,
-                                          feed_id=self.feed.pk,
-                                          read_date__gte=self.mark_read_date)
+        read_story_hashes = MReadStories.read_story_hashes(self.user.pk, self.feed.pk,
+                                                           since=self.mark_read_date)
         # if not silent:
         #     logging.info(' ---> [%s]    Read stories: %s' % (self.user, datetime.datetime.now() - now))
-        read_stories_ids = []
-        for us in read_stories:
-            if hasattr(us.story, 'story_guid') and isinstance(us.story.story_guid, unicode):
-                read_stories_ids.append(us.story.story_guid)
-            elif hasattr(us.story, 'id') and isinstance(us.story.id, unicode):
-                read_stories_ids.append(us.story.id) # TODO: Remove me after migration from story.id->guid
         stories_db = stories_db or MStory.objects(story_feed_id=self.feed.pk,
                                                   story_date__gte=date_delta)
         # if not silent:
@@ -107,50 +119,17 @@ class UserSubscription(models.Model):
         for story in stories_db:
             if story.story_date < date_delta:
                 continue
-            if hasattr(story, 'story_guid') and story.story_guid not in read_stories_ids:
-                unread_stories_db.append(story)
-            elif isinstance(story.id, unicode) and story.id not in read_stories_ids:
+            story_guid_hash = story.story_guid_hash or MStory.hash_guid(story.story_guid)
+            if story_guid_hash not in read_story_hashes:
                 unread_stories_db.append(story)
         stories = Feed.format_stories(unread_stories_db, self.feed.pk)
         # if not silent:
         #     logging.info(' ---> [%s]    Format stories: %s' % (self.user, datetime.datetime.now() - now))
         
-        classifier_feeds = MClassifierFeed.objects(user_id=self.user.pk, feed_id=self.feed.pk)
-        classifier_authors = MClassifierAuthor.objects(user_id=self.user.pk, feed_id=self.feed.pk)
-        classifier_titles = MClassifierTitle.objects(user_id=self.user.pk, feed_id=self.feed.pk)
-        classifier_tags = MClassifierTag.objects(user_id=self.user.pk, feed_id=self.feed.pk)
-        
-        # if not silent:
-        #     logging.info(' ---> [%s]    Classifiers: %s (%s)' % (self.user, datetime.datetime.now() - now, classifier_feeds.count() + classifier_authors.count() + classifier_tags.count() + classifier_titles.count()))
-            
-        scores = {
-            'feed': apply_classifier_feeds(classifier_feeds, self.feed),
-        }
+        classifiers = self.get_classifiers()
         
         for story in stories:
-            classifier_authors.rewind()
-            classifier_tags.rewind()
-            classifier_titles.rewind()
-            scores.update({
-                'author': apply_classifier_authors(classifier_authors, story),
-                'tags': apply_classifier_tags(classifier_tags, story),
-                'title': apply_classifier_titles(classifier_titles, story),
-            })
-            
-            max_score = max(scores['author'], scores['tags'], scores['title'])
-            min_score = min(scores['author'], scores['tags'], scores['title'])
-            if max_score > 0:
-                feed_scores['positive'] += 1
-            elif min_score < 0:
-                feed_scores['negative'] += 1
-            else:
-                if scores['feed'] > 0:
-                    feed_scores['positive'] += 1
-                elif scores['feed'] < 0:
-                    feed_scores['negative'] += 1
-                else:
-                    feed_scores['neutral'] += 1
-                
+            feed_scores[self.score_story(story, classifiers)] += 1
         
         # if not silent:
         #     logging.info(' ---> [%s]    End classifiers: %s' % (self.user, datetime.datetime.now() - now))
@@ -158,6 +137,7 @@ class UserSubscription(models.Model):
         self.unread_count_positive = feed_scores['positive']
         self.unread_count_neutral = feed_scores['neutral']
         self.unread_count_negative = feed_scores['negative']
+        self.unread_count_updated = datetime.datetime.utcnow()
         self.needs_unread_recalc = False
         
         self.save()
@@ -169,6 +149,154 @@ class UserSubscription(models.Model):
         cache.delete('usersub:%s' % self.user.id)
         
         return
+    
+    def get_classifiers(self):
+        return get_classifier_matcher(self.user_id, self.feed_id)
+    
+    def score_story(self, story, classifiers):
+        """
+        Which unread count a formatted story falls into: 'positive', 'neutral'
+        or 'negative'. Author, tag and title classifiers win over the feed's.
+        """
+        scores = classifiers.score(story)
+        
+        max_score = max(scores['author'], scores['tags'], scores['title'])
+        min_score = min(scores['author'], scores['tags'], scores['title'])
+        if max_score > 0:
+            return 'positive'
+        elif min_score < 0:
+            return 'negative'
+        elif scores['feed'] > 0:
+            return 'positive'
+        elif scores['feed'] < 0:
+            return 'negative'
+        return 'neutral'
+    
+    def update_unread_counts(self, stories_db, delta, classifiers=None):
+        """
+        Moves the unread counts by `delta` for each story in `stories_db` that
+        falls inside the unread window, in that story's score bucket. Use +1
+        for stories added or marked unread and -1 for stories read.
+        
+        Nothing to do while a full recalculation is pending, since it will
+        count these stories itself.
+        """
+        if self.needs_unread_recalc:
+            return
+        
+        UNREAD_CUTOFF = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
+        date_delta = max(UNREAD_CUTOFF, self.mark_read_date)
+        stories_db = [story for story in stories_db if story.story_date >= date_delta]
+        if not stories_db:
+            return
+        
+        if classifiers is None:
+            classifiers = self.get_classifiers()
+        deltas = defaultdict(int)
+        for story in Feed.format_stories(stories_db, self.feed_id):
+            deltas[self.score_story(story, classifiers)] += delta
+        
+        self.apply_unread_deltas(deltas)
+    
+    def apply_unread_deltas(self, deltas):
+        """
+        Adds {'positive': n, 'neutral': n, 'negative': n} to the unread counts
+        in one UPDATE, so concurrent adds and reads can't overwrite each other.
+        A count that drifts below zero gets a full recalculation instead.
+        """
+        deltas = dict((score, delta) for score, delta in deltas.items() if delta)
+        if not deltas:
+            return
+        
+        updates = {}
+        for score, delta in deltas.items():
+            field = 'unread_count_%s' % score
+            updates[field] = F(field) + delta
+            setattr(self, field, getattr(self, field) + delta)
+        if min(self.unread_count_positive, self.unread_count_neutral, self.unread_count_negative) < 0:
+            self.needs_unread_recalc = updates['needs_unread_recalc'] = True
+        UserSubscription.objects.filter(pk=self.pk).update(**updates)
+        
+        cache.delete('usersub:%s' % self.user_id)
+        if self.needs_unread_recalc:
+            UserSubscription.queue_recalc([self])
+    
+    @classmethod
+    def bulk_update_unread_counts(cls, feed, user_subs, stories_db, delta=1):
+        """
+        `update_unread_counts` for all of a feed's subscribers at once. The
+        stories are formatted once, every subscriber's classifiers come from
+        one query per classifier type, and subscribers whose counts move by
+        the same amounts share a single UPDATE. Untrained subscribers, who
+        are most of a popular feed's, aren't scored at all.
+        """
+        user_subs = [sub for sub in user_subs if not sub.needs_unread_recalc]
+        if not user_subs or not stories_db:
+            return
+        
+        user_ids = [sub.user_id for sub in user_subs]
+        classifiers = dict((user_id, dict(classifier_feeds=[], classifier_authors=[], 
+                                          classifier_titles=[], classifier_tags=[]))
+                           for user_id in user_ids)
+        for classifier_type, ClassifierCls in (('classifier_feeds', MClassifierFeed),
+                                               ('classifier_authors', MClassifierAuthor),
+                                               ('classifier_titles', MClassifierTitle),
+                                               ('classifier_tags', MClassifierTag)):
+            for classifier in ClassifierCls.objects(user_id__in=user_ids, feed_id=feed.pk):
+                classifiers[classifier.user_id][classifier_type].append(classifier)
+        
+        stories = zip(stories_db, Feed.format_stories(stories_db, feed.pk))
+        UNREAD_CUTOFF = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
+        
+        subs_by_deltas = defaultdict(list)
+        for sub in user_subs:
+            date_delta = max(UNREAD_CUTOFF, sub.mark_read_date)
+            sub_classifiers = ClassifierMatcher(feed.pk, **classifiers[sub.user_id])
+            deltas = dict(positive=0, neutral=0, negative=0)
+            for story_db, story in stories:
+                if story_db.story_date < date_delta:
+                    continue
+                if sub_classifiers.trained:
+                    deltas[sub.score_story(story, sub_classifiers)] += delta
+                else:
+                    deltas['neutral'] += delta
+            subs_by_deltas[(deltas['positive'], deltas['neutral'], deltas['negative'])].append(sub)
+        
+        for (positive, neutral, negative), subs in subs_by_deltas.items():
+            if not (positive or neutral or negative):
+                continue
+            cls.objects.filter(pk__in=[sub.pk for sub in subs]).update(
+                unread_count_positive=F('unread_count_positive') + positive,
+                unread_count_neutral=F('unread_count_neutral') + neutral,
+                unread_count_negative=F('unread_count_negative') + negative)
+            for sub in subs:
+                cache.delete('usersub:%s' % sub.user_id)
+    
+    @classmethod
+    def expire_unread_counts(cls, user):
+        """
+        Flags the user's subscriptions with unread stories whose counts were
+        last calculated over UNREAD_COUNTS_MAX_AGE ago. Some of the stories
+        counted then may since have aged out of the unread window.
+        """
+        expired_date = datetime.datetime.utcnow() - UNREAD_COUNTS_MAX_AGE
+        cls.objects.filter(user=user, active=True, needs_unread_recalc=False,
+                           unread_count_updated__lt=expired_date)\
+                   .exclude(unread_count_positive=0, unread_count_neutral=0, unread_count_negative=0)\
+                   .update(needs_unread_recalc=True)
+    
+    @classmethod
+    def queue_recalc(cls, user_subs):
+        """
+        Recalculates dirty subscriptions' unread counts on a background 
+        worker, off the request path. Each one is queued at most once a minute.
+        """
+        from apps.reader.tasks import CalculateFeedScores
+        
+        user_sub_ids = [sub.pk for sub in user_subs 
+                        if sub.needs_unread_recalc and cache.add('recalc_usersub:%s' % sub.pk, 1, 60)]
+        if user_sub_ids:
+            CalculateFeedScores.apply_async(args=(user_sub_ids,))
         
     class Meta:
         unique_together = ("user", "feed")
@@ -199,11 +327,16 @@ class MUserStory(mongo.Document):
     """
     Stories read by the user. These are deleted as the mark_read_date for the
     UserSubscription passes the UserStory date.
+    
+    The story's guid and date are copied onto the read record, so read 
+    stories can be listed with `.only()` without dereferencing `story`.
     """
     user_id = mongo.IntField()
     feed_id = mongo.IntField()
     read_date = mongo.DateTimeField()
     story = mongo.ReferenceField(MStory, unique_with=('user_id', 'feed_id'))
+    story_guid = mongo.StringField()
+    story_date = mongo.DateTimeField()
     
     meta = {
         'collection': 'userstories',
@@ -216,6 +349,170 @@ class MUserStory(mongo.Document):
         UNREAD_CUTOFF = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
         MUserStory.objects(feed_id=feed_id, read_date__lte=UNREAD_CUTOFF).delete()
     
+    @classmethod
+    def mark_stories_read(cls, user_id, feed_id, stories, read_date=None):
+        """
+        Saves read records for `stories`, with one query for the ones already
+        read and one bulk insert for the rest. Returns the stories that
+        weren't read before.
+        """
+        if not stories:
+            return []
+        read_date = read_date or datetime.datetime.utcnow()
+        collection = cls.objects._collection
+        
+        already_read = collection.find({'user_id': user_id, 'feed_id': feed_id,
+                                        'story.$id': {'$in': [story.id for story in stories]}},
+                                       ['story'])
+        already_read = set(us['story'].id for us in already_read)
+        unread_stories = [story for story in stories if story.id not in already_read]
+        if not unread_stories:
+            return []
+        
+        userstories = [cls(user_id=user_id, feed_id=feed_id, read_date=read_date, story=story,
+                           story_guid=story.story_guid, story_date=story.story_date).to_mongo()
+                       for story in unread_stories]
+        try:
+            collection.insert(userstories, safe=True)
+            return unread_stories
+        except pymongo.errors.OperationFailure:
+            # Another request read some of them in the meantime. Fall back to
+            # saving one at a time, skipping the duplicates.
+            read_stories = []
+            for story, userstory in zip(unread_stories, userstories):
+                try:
+                    collection.save(userstory, safe=True)
+                    read_stories.append(story)
+                except pymongo.errors.OperationFailure:
+                    pass
+            return read_stories
+    
+
+class MReadStories(mongo.Document):
+    """
+    A subscription's read state in one document: the guid hash of each read
+    story, mapped to when it was read. A feed's read stories come back in a
+    single read and are matched against stories in memory, instead of
+    dereferencing the story of every MUserStory.
+    
+    Built from MUserStory the first time a subscription's read state is
+    needed, or for everybody with the migrate_read_stories command. 
+    MUserStory is still written alongside it.
+    """
+    user_id = mongo.IntField()
+    feed_id = mongo.IntField(unique_with='user_id')
+    read_stories = mongo.DictField()
+    
+    meta = {
+        'collection': 'read_stories',
+        'indexes': [('user_id', 'feed_id'), 'feed_id'],
+        'allow_inheritance': False,
+    }
+    
+    @classmethod
+    def read_story_hashes(cls, user_id, feed_id, since=None):
+        since = since and {feed_id: since}
+        return cls.read_story_hashes_for_feeds(user_id, [feed_id], since)[feed_id]
+    
+    @classmethod
+    def read_story_hashes_for_feeds(cls, user_id, feed_ids, since=None):
+        """
+        Returns {feed_id: set of read story guid hashes} from one query.
+        `since` maps feed ids to their mark_read_date. Stories read before it
+        don't count any more, so they are dropped from the stored read state.
+        """
+        since = since or {}
+        collection = cls.objects._collection
+        read_states = dict((doc['feed_id'], doc.get('read_stories', {})) for doc in
+                           collection.find({'user_id': user_id, 'feed_id': {'$in': feed_ids}}))
+        
+        story_hashes = {}
+        for feed_id in feed_ids:
+            if feed_id not in read_states:
+                read_states[feed_id] = cls.migrate_from_userstories(user_id, feed_id)
+            read_stories = read_states[feed_id]
+            cutoff = since.get(feed_id)
+            expired = [story_hash for story_hash, read_date in read_stories.items()
+                       if cutoff and read_date < cutoff]
+            if expired:
+                collection.update({'user_id': user_id, 'feed_id': feed_id},
+                                  {'$unset': dict(('read_stories.%s' % story_hash, 1) 
+                                                  for story_hash in expired)})
+            story_hashes[feed_id] = set(read_stories) - set(expired)
+        
+        return story_hashes
+    
+    @classmethod
+    def mark_read(cls, user_id, feed_id, story_hashes, read_date=None):
+        if not story_hashes:
+            return
+        read_date = read_date or datetime.datetime.utcnow()
+        collection = cls.objects._collection
+        read = {'$set': dict(('read_stories.%s' % story_hash, read_date) 
+                             for story_hash in story_hashes)}
+        result = collection.update({'user_id': user_id, 'feed_id': feed_id}, read, safe=True)
+        if not result.get('updatedExisting'):
+            # Not migrated yet, so bring the older reads over first.
+            cls.migrate_from_userstories(user_id, feed_id)
+            collection.update({'user_id': user_id, 'feed_id': feed_id}, read, safe=True)
+    
+    @classmethod
+    def mark_unread(cls, user_id, feed_id, story_hashes):
+        if not story_hashes:
+            return
+        cls.objects._collection.update({'user_id': user_id, 'feed_id': feed_id},
+                                       {'$unset': dict(('read_stories.%s' % story_hash, 1)
+                                                       for story_hash in story_hashes)})
+    
+    @classmethod
+    def clear(cls, user_id, feed_id):
+        cls.objects._collection.update({'user_id': user_id, 'feed_id': feed_id},
+                                       {'$set': {'read_stories': {}}})
+    
+    @classmethod
+    def migrate_from_userstories(cls, user_id, feed_id):
+        """
+        Copies a subscription's MUserStory reads into its read state, creating
+        the document even with no reads so this only happens once. Returns the
+        read stories copied.
+        """
+        userstories = MUserStory.objects(user_id=user_id, feed_id=feed_id, story_guid__exists=True)\
+                                .only('story_guid', 'read_date')
+        read_stories = dict((MStory.hash_guid(us.story_guid), us.read_date) for us in userstories)
+        
+        # Older read records only have the story reference, so look their
+        # stories up together instead of dereferencing each one.
+        userstories = MUserStory.objects._collection.find({'user_id': user_id, 'feed_id': feed_id,
+                                                           'story_guid': {'$exists': False}},
+                                                          ['story', 'read_date'])
+        read_dates = dict((us['story'].id, us['read_date']) for us in userstories if us.get('story'))
+        if read_dates:
+            stories = MStory.objects(id__in=read_dates.keys()).only('story_guid', 'story_guid_hash')
+            for story in stories:
+                story_guid_hash = story.story_guid_hash or MStory.hash_guid(story.story_guid)
+                if story_guid_hash:
+                    read_stories[story_guid_hash] = read_dates[story.id]
+        
+        migrated = dict(('read_stories.%s' % story_hash, read_date) 
+                        for story_hash, read_date in read_stories.items())
+        migrated['feed_id'] = feed_id
+        cls.objects._collection.update({'user_id': user_id, 'feed_id': feed_id},
+                                       {'$set': migrated}, upsert=True, safe=True)
+        return read_stories
+    
+    @classmethod
+    def merge_feeds(cls, original_feed_id, duplicate_feed_id):
+        """
+        Drops the duplicate feed's read states and its readers' read states
+        for the original feed, which are rebuilt from MUserStory once its
+        reads have been moved over.
+        """
+        user_ids = [doc['user_id'] for doc in 
+                    cls.objects._collection.find({'feed_id': duplicate_feed_id}, ['user_id'])]
+        cls.objects(feed_id=duplicate_feed_id).delete()
+        if user_ids:
+            cls.objects(feed_id=original_feed_id, user_id__in=user_ids).delete()
+    
         
 class UserSubscriptionFolders(models.Model):
     """
@@ -232,6 +529,10 @@ class UserSubscriptionFolders(models.Model):
     class Meta:
         verbose_name_plural = "folders"
         verbose_name = "folder"
+    
+    def save(self, *args, **kwargs):
+        super(UserSubscriptionFolders, self).save(*args, **kwargs)
+        invalidate_feeds_snapshot(self.user_id)
         
     def delete_feed(self, feed_id, in_folder):
         def _find_feed_in_folders(old_folders, folder_name='', multiples_found=False, deleted=False):
@@ -275,6 +576,7 @@ class UserSubscriptionFolders(models.Model):
                         return
             user_sub.delete()
             MUserStory.objects(user_id=self.user.pk, feed_id=feed_id).delete()
+            MReadStories.objects(user_id=self.user.pk, feed_id=feed_id).delete()
 
     def delete_folder(self, folder_to_delete, in_folder, feed_ids_in_folder):
         def _find_folder_in_folders(old_folders, folder_name, feeds_to_delete):
@@ -300,6 +602,7 @@ class UserSubscriptionFolders(models.Model):
         self.save()
         
         UserSubscription.objects.filter(user=self.user, feed__in=feeds_to_delete).delete()
+        invalidate_feeds_snapshot(self.user_id)
         
     def rename_folder(self, folder_to_rename, new_folder_name, in_folder):
         def _find_folder_in_folders(old_folders, folder_name):
@@ -335,4 +638,106 @@ class Feature(models.Model):
     
     class Meta:
         ordering = ["-date"]
-        
\ No newline at end of file
+        
+
+def get_feeds_snapshot(user):
+    """
+    Everything load_feeds serves -- the user's feeds, folders and starred 
+    count -- as one cached read. Rebuilt only after a write has expired it.
+    Returns None if the user has no folders yet.
+    """
+    cache_key = 'usersub:%s' % user.pk
+    snapshot = cache.get(cache_key)
+    if snapshot is None:
+        snapshot = build_feeds_snapshot(user)
+        if snapshot is not None:
+            cache.set(cache_key, snapshot, FEEDS_SNAPSHOT_CACHE_SECONDS)
+    return snapshot
+
+def build_feeds_snapshot(user):
+    try:
+        folders = UserSubscriptionFolders.objects.get(user=user)
+    except UserSubscriptionFolders.DoesNotExist:
+        return None
+    except UserSubscriptionFolders.MultipleObjectsReturned:
+        UserSubscriptionFolders.objects.filter(user=user)[1:].delete()
+        folders = UserSubscriptionFolders.objects.get(user=user)
+    
+    feeds = {}
+    inactive_feeds = []
+    not_yet_fetched = False
+    user_subs = UserSubscription.objects.select_related('feed').filter(user=user)
+    
+    for sub in user_subs:
+        feeds[sub.feed.pk] = {
+            'id': sub.feed.pk,
+            'feed_title': sub.user_title or sub.feed.feed_title,
+            'feed_address': sub.feed.feed_address,
+            'feed_link': sub.feed.feed_link,
+            'ps': sub.unread_count_positive,
+            'nt': sub.unread_count_neutral,
+            'ng': sub.unread_count_negative, 
+            'last_update': sub.feed.last_update,
+            'subs': sub.feed.num_subscribers,
+            'active': sub.active
+        }
+        
+        if not sub.feed.fetched_once:
+            not_yet_fetched = True
+            feeds[sub.feed.pk]['not_yet_fetched'] = True
+        if sub.feed.has_page_exception or sub.feed.has_feed_exception:
+            feeds[sub.feed.pk]['has_exception'] = True
+            feeds[sub.feed.pk]['exception_type'] = 'feed' if sub.feed.has_feed_exception else 'page'
+            feeds[sub.feed.pk]['feed_address'] = sub.feed.feed_address
+            feeds[sub.feed.pk]['exception_code'] = sub.feed.exception_code
+        if not sub.feed.active and not sub.feed.has_feed_exception and not sub.feed.has_page_exception:
+            inactive_feeds.append(sub.feed)
+    
+    if not_yet_fetched:
+        for f in feeds:
+            if 'not_yet_fetched' not in feeds[f]:
+                feeds[f]['not_yet_fetched'] = False
+    
+    if inactive_feeds:
+        Feed.queue_repair(inactive_feeds)
+    
+    return {
+        'feeds': feeds,
+        'folders': json.decode(folders.folders),
+        'starred_count': MStarredStory.objects(user_id=user.pk).count(),
+    }
+
+def invalidate_feeds_snapshot(user_id):
+    cache.delete('usersub:%s' % user_id)
+
+def publish_feed_updates(user_ids):
+    """
+    Wakes the users' clients waiting in `wait_for_feed_updates`, by bumping
+    a per-user version in the cache. Only these users' keys change, so 
+    everyone else's waits stay idle.
+    """
+    for user_id in set(user_ids):
+        cache_key = 'feed_updates:%s' % user_id
+        # Seeded from the clock, so a version never repeats after an eviction.
+        cache.add(cache_key, int(time.time()), FEED_UPDATES_CACHE_SECONDS)
+        try:
+            cache.incr(cache_key)
+        except ValueError:
+            pass
+
+def wait_for_feed_updates(user_id, version, timeout):
+    """
+    Blocks until the user's feed update version differs from `version`, or 
+    for at most `timeout` seconds, and returns the current version. Each 
+    check is a single cache read.
+    """
+    cache_key = 'feed_updates:%s' % user_id
+    deadline = time.time() + timeout
+    while True:
+        current_version = cache.get(cache_key)
+        if current_version is None:
+            cache.add(cache_key, int(time.time()), FEED_UPDATES_CACHE_SECONDS)
+            current_version = cache.get(cache_key)
+        if str(current_version) != str(version) or time.time() >= deadline:
+            return current_version
+        time.sleep(FEED_UPDATES_POLL_SECONDS)
@@ -0,0 +1,65 @@
+import heapq
+import itertools
+from apps.rss_feeds.models import MStory
+from apps.reader.models import UserSubscription, MReadStories
+from utils.story_functions import milliseconds_since_epoch, encode_story_cursor
+from utils.story_functions import stories_after_cursor
+
+class RiverOfNews(object):
+    """
+    A user's unread stories across many feeds, newest first. Each feed is
+    read in batches off its (story_feed_id, -story_date) index, the feeds are
+    k-way merged, and read stories are dropped against the user's read state
+    in memory.
+
+    Pages are positioned by a cursor naming the last story handed out, so
+    stories read or added in the meantime don't shift the next page.
+    """
+
+    def __init__(self, user, feed_ids):
+        self.user = user
+        usersubs = UserSubscription.objects.filter(user=user, feed__in=feed_ids)
+        self.mark_read_dates = dict((sub.feed_id, sub.mark_read_date) for sub in usersubs)
+        self.feed_ids = self.mark_read_dates.keys()
+        self.read_story_hashes = MReadStories.read_story_hashes_for_feeds(user.pk, self.feed_ids,
+                                                                          since=self.mark_read_dates)
+
+    def stories(self, limit=25, cursor=None):
+        """
+        Returns (stories, cursor): up to `limit` unread MStories after
+        `cursor`, and the cursor to pass for the page after them.
+        """
+        feed_stories = [self.feed_stories(feed_id, cursor, limit) for feed_id in self.feed_ids]
+        page = [story for _, story in itertools.islice(heapq.merge(*feed_stories), limit)]
+
+        next_cursor = page and encode_story_cursor(page[-1].story_date, page[-1].id) or cursor
+
+        # Only the page's stories need their content.
+        stories = dict((story.id, story) for story in MStory.objects(id__in=[story.id for story in page]))
+        return [stories[story.id] for story in page if story.id in stories], next_cursor
+
+    def feed_stories(self, feed_id, cursor, batch_size):
+        """
+        Yields (sort key, story) for a feed's unread stories after `cursor`,
+        newest first, fetching just enough of each story to merge on.
+        """
+        read_story_hashes = self.read_story_hashes[feed_id]
+        while True:
+            stories = MStory.objects(story_feed_id=feed_id,
+                                     story_date__gte=self.mark_read_dates[feed_id])
+            stories = stories_after_cursor(stories, cursor)
+            stories = list(stories.only('id', 'story_date', 'story_guid', 'story_guid_hash')[:batch_size])
+
+            for story in stories:
+                story_guid_hash = story.story_guid_hash or MStory.hash_guid(story.story_guid)
+                if story_guid_hash not in read_story_hashes:
+                    yield self.sort_key(story), story
+
+            if len(stories) < batch_size:
+                return
+            cursor = encode_story_cursor(stories[-1].story_date, stories[-1].id)
+
+    @staticmethod
+    def sort_key(story):
+        # heapq merges smallest first, so negate to get the newest first.
+        return (-milliseconds_since_epoch(story.story_date), -int(str(story.id), 16))
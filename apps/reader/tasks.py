@@ -0,0 +1,15 @@
+from celery.task import Task
+
+class CalculateFeedScores(Task):
+    name = 'calculate-feed-scores'
+    max_retries = 0
+    ignore_result = True
+
+    def run(self, user_sub_ids, **kwargs):
+        from apps.reader.models import UserSubscription, publish_feed_updates
+        
+        user_subs = UserSubscription.objects.select_related('feed', 'user').filter(pk__in=user_sub_ids,
+                                                                                    needs_unread_recalc=True)
+        for sub in user_subs:
+            sub.calculate_feed_scores(silent=True)
+        publish_feed_updates([sub.user_id for sub in user_subs])
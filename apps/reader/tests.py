@@ -4,6 +4,10 @@ from django.test import TestCase
 from django.core import management
 from pprint import pprint
 from django.core.urlresolvers import reverse
+from django.contrib.auth.models import User
+import datetime
+from apps.rss_feeds.models import Feed, MStory
+from apps.reader.models import UserSubscription, UNREAD_COUNTS_MAX_AGE
 
 class ReaderTest(TestCase):
     fixtures = ['reader.json', 'stories.json']
@@ -89,4 +93,61 @@ class ReaderTest(TestCase):
         
         self.assert_(connection.queries)
         
-        settings.DEBUG = False
\ No newline at end of file
+        settings.DEBUG = False
+
+class UnreadCountsTest(TestCase):
+    
+    def setUp(self):
+        now = datetime.datetime.utcnow()
+        self.user = User.objects.create(username='unread_counts')
+        self.feed = Feed.objects.create(feed_address='http://example.com/unread.xml',
+                                        feed_link='http://example.com/', 
+                                        feed_title='Unread Counts', fetched_once=True)
+        self.usersub = UserSubscription.objects.create(user=self.user, feed=self.feed, active=True,
+                                                       mark_read_date=now - datetime.timedelta(days=1),
+                                                       unread_count_updated=now)
+        self.stories = []
+        for i, hours in enumerate([1, 2, 3, 24*365]):
+            story = MStory(story_feed_id=self.feed.pk, story_guid=u'unread-counts-%s' % i,
+                           story_title=u'Story %s' % i, story_content=u'Content %s' % i,
+                           story_permalink=u'http://example.com/%s' % i,
+                           story_date=now - datetime.timedelta(hours=hours))
+            story.save()
+            self.stories.append(story)
+    
+    def tearDown(self):
+        MStory.objects(story_feed_id=self.feed.pk).delete()
+    
+    def reload_usersub(self):
+        return UserSubscription.objects.get(pk=self.usersub.pk)
+    
+    def test_update_unread_counts__add_read_unread(self):
+        # Added, skipping the story older than mark_read_date.
+        self.usersub.update_unread_counts(self.stories, 1)
+        self.assertEquals(self.reload_usersub().unread_count_neutral, 3)
+        
+        # Read
+        self.usersub.update_unread_counts(self.stories[:2], -1)
+        self.assertEquals(self.reload_usersub().unread_count_neutral, 1)
+        
+        # Marked unread
+        self.usersub.update_unread_counts(self.stories[1:2], 1)
+        usersub = self.reload_usersub()
+        self.assertEquals(usersub.unread_count_neutral, 2)
+        self.assertEquals(usersub.unread_count_positive, 0)
+        self.assertEquals(usersub.unread_count_negative, 0)
+        self.assertFalse(usersub.needs_unread_recalc)
+    
+    def test_bulk_update_unread_counts(self):
+        UserSubscription.bulk_update_unread_counts(self.feed, [self.usersub], self.stories, 1)
+        self.assertEquals(self.reload_usersub().unread_count_neutral, 3)
+    
+    def test_expire_unread_counts(self):
+        self.usersub.update_unread_counts(self.stories, 1)
+        UserSubscription.expire_unread_counts(self.user)
+        self.assertFalse(self.reload_usersub().needs_unread_recalc)
+        
+        expired_date = datetime.datetime.utcnow() - UNREAD_COUNTS_MAX_AGE - datetime.timedelta(hours=1)
+        UserSubscription.objects.filter(pk=self.usersub.pk).update(unread_count_updated=expired_date)
+        UserSubscription.expire_unread_counts(self.user)
+        self.assertTrue(self.reload_usersub().needs_unread_recalc)
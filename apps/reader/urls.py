@@ -13,6 +13,7 @@ urlpatterns = patterns('',
     url(r'^load_feeds', views.load_feeds, name='load-feeds'),
     url(r'^load_river_stories', views.load_river_stories, name='load-river-storiesw'),
     url(r'^refresh_feeds', views.refresh_feeds, name='refresh-feeds'),
+    url(r'^feed_updates', views.feed_updates, name='feed-updates'),
     url(r'^load_starred_stories', views.load_starred_stories, name='load-starred-stories'),
     url(r'^mark_all_as_read', views.mark_all_as_read, name='mark-all-as-read'),
     url(r'^mark_story_as_read', views.mark_story_as_read),
@@ -1,5 +1,6 @@
 import datetime
 import random
+import time
 import zlib
 from django.shortcuts import render_to_response, get_object_or_404
 from django.contrib.auth.decorators import login_required
@@ -13,11 +14,13 @@ from django.contrib.auth.models import User
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, Http404
 from django.conf import settings
 from django.core.mail import mail_admins
+from django.core.cache import cache
 from mongoengine.queryset import OperationError, Q
 from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
-from apps.analyzer.models import apply_classifier_titles, apply_classifier_feeds, apply_classifier_authors, apply_classifier_tags
-from apps.analyzer.models import get_classifiers_for_user
-from apps.reader.models import UserSubscription, UserSubscriptionFolders, MUserStory, Feature
+from apps.analyzer.models import get_classifier_bundle, get_classifier_matcher
+from apps.reader.models import UserSubscription, UserSubscriptionFolders, MUserStory, MReadStories, Feature
+from apps.reader.models import get_feeds_snapshot, invalidate_feeds_snapshot, wait_for_feed_updates
+from apps.reader.river import RiverOfNews
 from apps.reader.forms import SignupForm, LoginForm, FeatureForm
 try:
     from apps.rss_feeds.models import Feed, MFeedPage, DuplicateFeed, MStory, MStarredStory, FeedLoadtime
@@ -28,10 +31,15 @@ from utils.user_functions import get_user, ajax_login_required
 from utils.feed_functions import fetch_address_from_page, relative_timesince
 from utils.story_functions import format_story_link_date__short
 from utils.story_functions import format_story_link_date__long
+from utils.story_functions import encode_story_cursor, stories_after_cursor
 from utils import log as logging
 from utils.timezones.utilities import localtime_for_timezone
 
 SINGLE_DAY = 60*60*24
+REFRESH_FEEDS_CACHE_SECONDS = 60*60
+# Each waiting client holds a web worker this long, so keep it short on
+# sync workers. Deployments on async workers can raise it in settings.
+FEED_UPDATES_TIMEOUT = getattr(settings, 'FEED_UPDATES_TIMEOUT', 5)
 
 @never_cache
 def index(request):
@@ -118,60 +126,22 @@ def logout(request):
     
 @json.json_view
 def load_feeds(request):
-    user            = get_user(request)
-    feeds           = {}
-    not_yet_fetched = False
+    user     = get_user(request)
+    snapshot = get_feeds_snapshot(user)
     
-    try:
-        folders = UserSubscriptionFolders.objects.get(user=user)
-    except UserSubscriptionFolders.DoesNotExist:
+    if snapshot is None:
         data = dict(feeds=[], folders=[])
         return data
-    except UserSubscriptionFolders.MultipleObjectsReturned:
-        UserSubscriptionFolders.objects.filter(user=user)[1:].delete()
-        folders = UserSubscriptionFolders.objects.get(user=user)
-        
-    user_subs = UserSubscription.objects.select_related('feed').filter(user=user)
     
-    for sub in user_subs:
-        feeds[sub.feed.pk] = {
-            'id': sub.feed.pk,
-            'feed_title': sub.user_title or sub.feed.feed_title,
-            'feed_address': sub.feed.feed_address,
-            'feed_link': sub.feed.feed_link,
-            'ps': sub.unread_count_positive,
-            'nt': sub.unread_count_neutral,
-            'ng': sub.unread_count_negative, 
-            'updated': relative_timesince(sub.feed.last_update),
-            'subs': sub.feed.num_subscribers,
-            'active': sub.active
-        }
-        
-        if not sub.feed.fetched_once:
-            not_yet_fetched = True
-            feeds[sub.feed.pk]['not_yet_fetched'] = True
-        if sub.feed.has_page_exception or sub.feed.has_feed_exception:
-            feeds[sub.feed.pk]['has_exception'] = True
-            feeds[sub.feed.pk]['exception_type'] = 'feed' if sub.feed.has_feed_exception else 'page'
-            feeds[sub.feed.pk]['feed_address'] = sub.feed.feed_address
-            feeds[sub.feed.pk]['exception_code'] = sub.feed.exception_code
-        if not sub.feed.active and not sub.feed.has_feed_exception and not sub.feed.has_page_exception:
-            sub.feed.count_subscribers()
-            sub.feed.schedule_feed_fetch_immediately()
-            
-    if not_yet_fetched:
-        for f in feeds:
-            if 'not_yet_fetched' not in feeds[f]:
-                feeds[f]['not_yet_fetched'] = False
-
-    starred_count = MStarredStory.objects(user_id=user.pk).count()
-
-    data = {
-        'feeds': feeds,
-        'folders': json.decode(folders.folders),
-        'starred_count': starred_count,
-    }
-    return data
+    # Feeds are fetched far more often than the snapshot is rebuilt, so read
+    # their fetch times fresh. One indexed lookup, two columns.
+    last_updates = dict(Feed.objects.filter(pk__in=snapshot['feeds'].keys())
+                                    .values_list('pk', 'last_update'))
+    for feed_id, feed in snapshot['feeds'].items():
+        last_update = feed.pop('last_update')
+        feed['updated'] = relative_timesince(last_updates.get(feed_id) or last_update)
+    
+    return snapshot
 
 @ajax_login_required
 @json.json_view
@@ -186,10 +156,9 @@ def load_feeds_iphone(request):
         return data
         
     user_subs = UserSubscription.objects.select_related('feed').filter(user=user)
+    UserSubscription.queue_recalc(user_subs)
 
     for sub in user_subs:
-        if sub.needs_unread_recalc:
-            sub.calculate_feed_scores(silent=True)
         feeds[sub.feed.pk] = {
             'id': sub.feed.pk,
             'feed_title': sub.user_title or sub.feed.feed_title,
@@ -228,36 +197,80 @@ def load_feeds_iphone(request):
 
 @json.json_view
 def refresh_feeds(request):
-    user = get_user(request)
-    feeds = {}
-    user_subs = UserSubscription.objects.select_related('feed').filter(user=user, active=True)
+    """
+    Returns only the subscriptions whose unread counts or exception state
+    changed since the `version` the client last got, and the version to send
+    next time. Without a version, or with one that has expired, every
+    subscription is returned.
+    """
+    user               = get_user(request)
+    version            = request.POST.get('version')
+    check_fetch_status = request.POST.get('check_fetch_status', False)
+    
+    UserSubscription.expire_unread_counts(user)
+    dirty_subs = UserSubscription.objects.filter(user=user, active=True, needs_unread_recalc=True)
+    UserSubscription.queue_recalc(dirty_subs)
+    
+    snapshot = get_feeds_snapshot(user)
+    if snapshot is None:
+        return {'feeds': {}, 'version': version}
+    
+    feeds = _refresh_feeds_state(snapshot)
+    seen_feeds = version and cache.get('refresh_feeds:%s:%s' % (user.pk, version)) or {}
+    changed_feeds = dict((feed_id, feed) for feed_id, feed in feeds.items()
+                         if seen_feeds.get(feed_id) != feed)
+    
+    if changed_feeds or not version or not seen_feeds:
+        # Seeded from the clock, so versions keep increasing if the counter is evicted.
+        version_key = 'refresh_feeds_version:%s' % user.pk
+        cache.add(version_key, int(time.time()), SINGLE_DAY)
+        try:
+            version = cache.incr(version_key)
+        except ValueError:
+            # Evicted between the add and the incr, or no cache at all.
+            version = int(time.time())
+        cache.set('refresh_feeds:%s:%s' % (user.pk, version), feeds, REFRESH_FEEDS_CACHE_SECONDS)
+    
+    if not check_fetch_status:
+        for feed in changed_feeds.values():
+            del feed['not_yet_fetched']
+    
+    return {'feeds': changed_feeds, 'version': version}
 
-    for sub in user_subs:
-        if sub.needs_unread_recalc:
-            sub.calculate_feed_scores(silent=True)
-        feeds[sub.feed.pk] = {
-            'ps': sub.unread_count_positive,
-            'nt': sub.unread_count_neutral,
-            'ng': sub.unread_count_negative,
+@ajax_login_required
+@json.json_view
+def feed_updates(request):
+    """
+    Long poll. Returns as soon as one of the user's feeds has new stories,
+    or after FEED_UPDATES_TIMEOUT seconds. The client passes back the
+    version from the last response, and calls refresh_feeds when it changes.
+    """
+    version = request.POST.get('version')
+    new_version = wait_for_feed_updates(request.user.pk, version, FEED_UPDATES_TIMEOUT)
+    
+    return {'version': new_version}
+
+def _refresh_feeds_state(snapshot):
+    feeds = {}
+    for feed_id, feed in snapshot['feeds'].items():
+        if not feed['active']:
+            continue
+        feeds[feed_id] = {
+            'ps': feed['ps'],
+            'nt': feed['nt'],
+            'ng': feed['ng'],
+            'not_yet_fetched': feed.get('not_yet_fetched', False),
         }
-        if sub.feed.has_feed_exception or sub.feed.has_page_exception:
-            feeds[sub.feed.pk]['has_exception'] = True
-            feeds[sub.feed.pk]['exception_type'] = 'feed' if sub.feed.has_feed_exception else 'page'
-            feeds[sub.feed.pk]['feed_address'] = sub.feed.feed_address
-            feeds[sub.feed.pk]['exception_code'] = sub.feed.exception_code
-        if request.POST.get('check_fetch_status', False):
-            feeds[sub.feed.pk]['not_yet_fetched'] = not sub.feed.fetched_once
-            
-    return {'feeds': feeds}
+        if feed.get('has_exception'):
+            for key in ('has_exception', 'exception_type', 'feed_address', 'exception_code'):
+                feeds[feed_id][key] = feed[key]
+    return feeds
 
 @json.json_view
 def load_single_feed(request):
     user = get_user(request)
-    offset = int(request.REQUEST.get('offset', 0))
     limit = int(request.REQUEST.get('limit', 30))
-    page = int(request.REQUEST.get('page', 0))
-    if page:
-        offset = limit * page
+    cursor = request.REQUEST.get('cursor')
     feed_id = int(request.REQUEST.get('feed_id', 0))
     if feed_id == 0:
         raise Http404
@@ -275,40 +288,25 @@ def load_single_feed(request):
     force_update = request.GET.get('force_update', False)
     
     now = datetime.datetime.utcnow()
-    stories = feed.get_stories(offset, limit) 
+    stories, cursor = feed.get_stories(limit, cursor)
         
     if force_update:
         feed.update(force_update)
     
     # Get intelligence classifier for user
-    classifier_feeds = MClassifierFeed.objects(user_id=user.pk, feed_id=feed_id)
-    classifier_authors = MClassifierAuthor.objects(user_id=user.pk, feed_id=feed_id)
-    classifier_titles = MClassifierTitle.objects(user_id=user.pk, feed_id=feed_id)
-    classifier_tags = MClassifierTag.objects(user_id=user.pk, feed_id=feed_id)
+    classifier_matcher = get_classifier_matcher(user.pk, feed_id)
     
     usersub = UserSubscription.objects.get(user=user, feed=feed)        
-    userstories = []
-    userstories_db = MUserStory.objects(user_id=user.pk, 
-                                        feed_id=feed.pk,
-                                        read_date__gte=usersub.mark_read_date)
+    read_story_hashes = MReadStories.read_story_hashes(user.pk, feed.pk, 
+                                                       since=usersub.mark_read_date)
     starred_stories = MStarredStory.objects(user_id=user.pk, story_feed_id=feed_id).only('story_guid', 'starred_date')
     starred_stories = dict([(story.story_guid, story.starred_date) for story in starred_stories])
 
-    for us in userstories_db:
-        if hasattr(us.story, 'story_guid') and isinstance(us.story.story_guid, unicode):
-            userstories.append(us.story.story_guid)
-        elif hasattr(us.story, 'id') and isinstance(us.story.id, unicode):
-            userstories.append(us.story.id) # TODO: Remove me after migration from story.id->guid
-            
     for story in stories:
-        classifier_feeds.rewind()
-        classifier_authors.rewind()
-        classifier_tags.rewind()
-        classifier_titles.rewind()
         story_date = localtime_for_timezone(story['story_date'], user.profile.timezone)
         story['short_parsed_date'] = format_story_link_date__short(story_date)
         story['long_parsed_date'] = format_story_link_date__long(story_date)
-        if story['id'] in userstories:
+        if MStory.hash_guid(story['id']) in read_story_hashes:
             story['read_status'] = 1
         elif not story.get('read_status') and story['story_date'] < usersub.mark_read_date:
             story['read_status'] = 1
@@ -318,18 +316,12 @@ def load_single_feed(request):
             story['starred'] = True
             starred_date = localtime_for_timezone(starred_stories[story['id']], user.profile.timezone)
             story['starred_date'] = format_story_link_date__long(starred_date)
-        story['intelligence'] = {
-            'feed': apply_classifier_feeds(classifier_feeds, feed),
-            'author': apply_classifier_authors(classifier_authors, story),
-            'tags': apply_classifier_tags(classifier_tags, story),
-            'title': apply_classifier_titles(classifier_titles, story),
-        }
+        story['intelligence'] = classifier_matcher.score(story)
     
     # Intelligence
     feed_tags = json.decode(feed.popular_tags) if feed.popular_tags else []
     feed_authors = json.decode(feed.popular_authors) if feed.popular_authors else []
-    classifiers = get_classifiers_for_user(user, feed_id, classifier_feeds, 
-                                           classifier_authors, classifier_titles, classifier_tags)
+    classifiers = classifier_matcher.payload
     
     usersub.feed_opens += 1
     usersub.save()
@@ -345,7 +337,8 @@ def load_single_feed(request):
                 feed_authors=feed_authors, 
                 classifiers=classifiers,
                 last_update=last_update,
-                feed_id=feed.pk)
+                feed_id=feed.pk,
+                cursor=cursor)
     return data
 
 def load_feed_page(request):
@@ -371,12 +364,13 @@ def load_feed_page(request):
 @json.json_view
 def load_starred_stories(request):
     user = get_user(request)
-    offset = int(request.REQUEST.get('offset', 0))
     limit = int(request.REQUEST.get('limit', 10))
-    page = int(request.REQUEST.get('page', 0))
-    if page: offset = limit * page
+    cursor = request.REQUEST.get('cursor')
         
-    mstories = MStarredStory.objects(user_id=user.pk).order_by('-starred_date')[offset:offset+limit]
+    mstories = MStarredStory.objects(user_id=user.pk)
+    mstories = list(stories_after_cursor(mstories, cursor, date_field='starred_date')[:limit])
+    if mstories:
+        cursor = encode_story_cursor(mstories[-1].starred_date, mstories[-1].id)
     stories = Feed.format_stories(mstories)
     
     for story in stories:
@@ -396,31 +390,17 @@ def load_starred_stories(request):
     
     logging.info(" ---> [%s] ~FCLoading starred stories: ~SB%s stories" % (request.user, len(stories)))
     
-    return dict(stories=stories)
+    return dict(stories=stories, cursor=cursor)
 
 @json.json_view
 def load_river_stories(request):
     user = get_user(request)
     feed_ids = [int(feed_id) for feed_id in request.POST.getlist('feeds')]
-    offset = int(request.REQUEST.get('offset', 0))
     limit = int(request.REQUEST.get('limit', 25))
-    page = int(request.REQUEST.get('page', 0))+1
-    read_stories = int(request.REQUEST.get('read_stories', 0))
-    # if page: offset = limit * page
-    if page: limit = limit * page - read_stories
-
-    def feed_qvalues(feed_id):
-        feed = UserSubscription.objects.get(feed__pk=feed_id, user=user)
-        return Q(story_feed_id=feed_id) & Q(story_date__gte=feed.mark_read_date)
-    feed_last_reads = map(feed_qvalues, feed_ids)
-    qs = reduce(lambda q1, q2: q1 | q2, feed_last_reads)
-    
-    read_stories = MUserStory.objects(user_id=user.pk, feed_id__in=feed_ids).only('story')
-    read_stories = [rs.story.id for rs in read_stories]
-    mstories = MStory.objects(
-        Q(id__nin=read_stories) & 
-        qs
-    )[offset:offset+limit]
+    cursor = request.REQUEST.get('cursor')
+    
+    river = RiverOfNews(user, feed_ids)
+    mstories, cursor = river.stories(limit=limit, cursor=cursor)
     stories = Feed.format_stories(mstories)
     
     starred_stories = MStarredStory.objects(
@@ -429,7 +409,7 @@ def load_river_stories(request):
     ).only('story_guid', 'starred_date')
     starred_stories = dict([(story.story_guid, story.starred_date) 
                             for story in starred_stories])
-                            
+    classifier_bundle = get_classifier_bundle(user.pk)
     
     for story in stories:
         story_date = localtime_for_timezone(story['story_date'], user.profile.timezone)
@@ -440,17 +420,13 @@ def load_river_stories(request):
             story['starred'] = True
             starred_date = localtime_for_timezone(starred_stories[story['id']], user.profile.timezone)
             story['starred_date'] = format_story_link_date__long(starred_date)
-        story['intelligence'] = {
-            'feed': 0,
-            'author': 0,
-            'tags': 0,
-            'title': 0,
-        }
+        story['intelligence'] = classifier_bundle.matcher(story['story_feed_id']).score(story)
     
     logging.info(" ---> [%s] ~FCLoading river stories: ~SB%s stories ~SN(%s feeds)" % (
                  request.user, len(stories), len(feed_ids)))
     
-    return dict(stories=stories)
+    return dict(stories=stories, cursor=cursor)
+    
 @ajax_login_required
 @json.json_view
 def mark_all_as_read(request):
@@ -467,6 +443,7 @@ def mark_all_as_read(request):
                 sub.needs_unread_recalc = True
                 sub.mark_read_date = read_date
                 sub.save()
+    UserSubscription.queue_recalc(feeds)
     
     logging.info(" ---> [%s] ~FMMarking all as read: ~SB%s days" % (request.user, days,))
     return dict(code=code)
@@ -487,28 +464,33 @@ def mark_story_as_read(request):
                                                        feed=duplicate_feed[0].feed)
             except Feed.DoesNotExist:
                 return dict(code=-1)
-                
-    if not usersub.needs_unread_recalc:
-        usersub.needs_unread_recalc = True
-        usersub.save()
         
-    data = dict(code=0, payload=story_ids)
-    
     if len(story_ids) > 1:
         logging.info(" ---> [%s] ~FYRead %s stories in feed: %s" % (request.user, len(story_ids), usersub.feed))
     else:
         logging.info(" ---> [%s] ~FYRead story in feed: %s" % (request.user, usersub.feed))
-        
+    
+    stories = MStory.objects(story_feed_id=feed_id, story_guid__in=story_ids)
+    stories = dict((story.story_guid, story) for story in stories)
+    now = datetime.datetime.utcnow()
+    read_stories = MUserStory.mark_stories_read(request.user.pk, feed_id, stories.values(), now)
+    read_story_ids = set(story.story_guid for story in read_stories)
+    
+    statuses = {}
     for story_id in story_ids:
-        story = MStory.objects(story_feed_id=feed_id, story_guid=story_id)[0]
-        now = datetime.datetime.utcnow()
-        m = MUserStory(story=story, user_id=request.user.pk, feed_id=feed_id, read_date=now)
-        try:
-            m.save()
-        except OperationError:
+        if story_id in read_story_ids:
+            statuses[story_id] = 'read'
+        elif story_id in stories:
+            statuses[story_id] = 'duplicate'
             logging.info(' ---> [%s] ~BRMarked story as read: Duplicate Story -> %s' % (request.user, story_id))
+        else:
+            statuses[story_id] = 'missing'
     
-    return data
+    MReadStories.mark_read(request.user.pk, feed_id, [MStory.hash_guid(story_id) 
+                                                      for story_id in stories], now)
+    usersub.update_unread_counts(read_stories, -1)
+    
+    return dict(code=0, payload=story_ids, statuses=statuses)
     
 @ajax_login_required
 @json.json_view
@@ -526,10 +508,6 @@ def mark_story_as_unread(request):
                                                        feed=duplicate_feed[0].feed)
             except Feed.DoesNotExist:
                 return dict(code=-1)
-                
-    if not usersub.needs_unread_recalc:
-        usersub.needs_unread_recalc = True
-        usersub.save()
         
     data = dict(code=0, payload=dict(story_id=story_id))
     logging.info(" ---> [%s] ~FY~SBUnread~SN story in feed: %s" % (request.user, usersub.feed))
@@ -537,7 +515,10 @@ def mark_story_as_unread(request):
     story = MStory.objects(story_feed_id=feed_id, story_guid=story_id)[0]
     now = datetime.datetime.utcnow()
     m = MUserStory.objects(story=story, user_id=request.user.pk, feed_id=feed_id)
-    m.delete()
+    if m.count():
+        m.delete()
+        usersub.update_unread_counts([story], 1)
+    MReadStories.mark_unread(request.user.pk, feed_id, [MStory.hash_guid(story.story_guid)])
     
     return data
     
@@ -563,6 +544,7 @@ def mark_feed_as_read(request):
         
         logging.info(" ---> [%s] ~FMMarking feed as read: ~SB%s" % (request.user, feed,))
         MUserStory.objects(user_id=request.user.pk, feed_id=feed_id).delete()
+        MReadStories.clear(request.user.pk, feed.pk)
     return dict(code=code)
 
 def _parse_user_info(user):
@@ -782,10 +764,11 @@ def get_feeds_trainer(request):
         usersubs = usersubs.filter(feed=feed)
     usersubs = usersubs.select_related('feed').order_by('-feed__stories_last_month')
                 
+    classifier_bundle = get_classifier_bundle(user.pk)
     for us in usersubs:
         if (not us.is_trained and us.feed.stories_last_month > 0) or feed_id:
             classifier = dict()
-            classifier['classifiers'] = get_classifiers_for_user(user, us.feed.pk)
+            classifier['classifiers'] = classifier_bundle.matcher(us.feed.pk).payload
             classifier['feed_id'] = us.feed.pk
             classifier['stories_last_month'] = us.feed.stories_last_month
             classifier['feed_tags'] = json.decode(us.feed.popular_tags) if us.feed.popular_tags else []
@@ -882,6 +865,7 @@ def mark_story_as_starred(request):
         now = datetime.datetime.now()
         story_values = dict(user_id=request.user.pk, starred_date=now, **story_db)
         MStarredStory.objects.create(**story_values)
+        invalidate_feeds_snapshot(request.user.pk)
         logging.info(' ---> [%s] ~FCStarring: ~SB%s' % (request.user, story[0].story_title[:50]))
     else:
         code = -1
@@ -898,6 +882,7 @@ def mark_story_as_unstarred(request):
     if starred_story:
         logging.info(' ---> [%s] ~FCUnstarring: ~SB%s' % (request.user, starred_story[0].story_title[:50]))
         starred_story.delete()
+        invalidate_feeds_snapshot(request.user.pk)
     else:
         code = -1
     
@@ -7,6 +7,7 @@ import multiprocessing
 import traceback
 import feedparser
 from utils import log as logging
+from utils import http_pool
 from apps.rss_feeds.models import MFeedPage
 
 class PageImporter(object):
@@ -22,7 +23,7 @@ class PageImporter(object):
         
         try:
             request = urllib2.Request(self.url)
-            response = urllib2.urlopen(request)
+            response = http_pool.urlopen(request)
             data = response.read()
             html = self.rewrite_page(data)
             self.save_page(html)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed, MStory
+from apps.reader.models import MUserStory
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--feed", dest="feed", default=None),
+        make_option("-V", "--verbose", dest="verbose", action="store_true"),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Copies story_guid and story_date onto read stories saved before they
+        were stored on MUserStory.
+        """
+        if options['feed']:
+            feeds = Feed.objects.filter(pk=options['feed'])
+        else:
+            feeds = Feed.objects.all()
+
+        userstories_db = MUserStory.objects._collection
+        backfilled = 0
+        for feed in feeds:
+            userstories = userstories_db.find({'feed_id': feed.pk, 'story_guid': {'$exists': False}},
+                                              ['story'])
+            story_ids = set(us['story'].id for us in userstories if us.get('story'))
+            if not story_ids:
+                continue
+            stories = MStory.objects(id__in=list(story_ids)).only('story_guid', 'story_date')
+            for story in stories:
+                userstories_db.update({'feed_id': feed.pk, 'story.$id': story.id},
+                                      {'$set': {'story_guid': story.story_guid,
+                                                'story_date': story.story_date}},
+                                      multi=True)
+            backfilled += len(story_ids)
+            if options['verbose']:
+                print "  ---> %s [%s]: %s read stories" % (feed.feed_title, feed.pk, len(story_ids))
+
+        print "\nBackfilled %s read stories" % backfilled
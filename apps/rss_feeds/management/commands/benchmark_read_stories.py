@@ -0,0 +1,71 @@
+import datetime
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from mongoengine import connect
+from pymongo import Connection
+from apps.rss_feeds.models import MStory
+from apps.reader.models import MUserStory, MReadStories
+from optparse import make_option
+
+# Scratch database the benchmark writes to, and drops when it's done.
+BENCHMARK_DB = 'newsblur_benchmark'
+BENCHMARK_USER_ID = -1
+BENCHMARK_FEED_ID = -1
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-n", "--number", type="int", dest="number", default=5000,
+            help="Read stories to give the benchmark user."),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Times building one user's read set three ways: dereferencing each
+        MUserStory's story, reading the guids denormalised onto MUserStory
+        with .only(), and loading the MReadStories document.
+        
+        Runs against BENCHMARK_DB, so the live collections are never touched.
+        """
+        connect(BENCHMARK_DB, host=settings.MONGO_DB['HOST'], port=settings.MONGO_DB['PORT'])
+        try:
+            self.create_read_stories(options['number'])
+            query = dict(user_id=BENCHMARK_USER_ID, feed_id=BENCHMARK_FEED_ID)
+            timings = [
+                ('Dereferenced story', 
+                 lambda: set(us.story.story_guid for us in MUserStory.objects(**query))),
+                ('Denormalised .only()',
+                 lambda: set(us.story_guid for us in MUserStory.objects(**query).only('story_guid'))),
+                ('MReadStories',
+                 lambda: MReadStories.read_story_hashes(BENCHMARK_USER_ID, BENCHMARK_FEED_ID)),
+            ]
+            # Build the read state first, so only loading it is timed.
+            MReadStories.migrate_from_userstories(BENCHMARK_USER_ID, BENCHMARK_FEED_ID)
+            
+            print " ---> %s read stories" % options['number']
+            for name, build_read_set in timings:
+                start = time.time()
+                read_set = build_read_set()
+                assert len(read_set) == options['number']
+                print " ---> %-22s %.3fs" % (name + ':', time.time() - start)
+        finally:
+            conn = Connection(host=settings.MONGO_DB['HOST'], port=settings.MONGO_DB['PORT'])
+            conn.drop_database(BENCHMARK_DB)
+
+    def create_read_stories(self, number):
+        now = datetime.datetime.utcnow()
+        stories = [MStory(story_feed_id=BENCHMARK_FEED_ID, 
+                          story_guid=u'http://example.com/benchmark/%s' % i,
+                          story_title=u'Benchmark story %s' % i,
+                          story_date=now - datetime.timedelta(minutes=i))
+                   for i in xrange(number)]
+        story_docs = [story.to_mongo() for story in stories]
+        MStory.objects._collection.insert(story_docs, safe=True)
+        for story, story_doc in zip(stories, story_docs):
+            story.id = story_doc['_id']
+        
+        userstories = [MUserStory(user_id=BENCHMARK_USER_ID, feed_id=BENCHMARK_FEED_ID, 
+                                  read_date=now, story=story, story_guid=story.story_guid,
+                                  story_date=story.story_date).to_mongo()
+                       for story in stories]
+        MUserStory.objects._collection.insert(userstories, safe=True)
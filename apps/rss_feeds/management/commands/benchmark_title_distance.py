@@ -0,0 +1,56 @@
+import timeit
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import MStory
+from utils.feed_functions import levenshtein_distance, bounded_levenshtein_distance
+from optparse import make_option
+
+# Title pairs like the ones _exists_story compares: fixed typos, edited
+# headlines, and unrelated stories from the same feed.
+SAMPLE_TITLES = [
+    (u"Apple Announces New MacBook Pro With Faster Processors",
+     u"Apple Announces New MacBook Pros With Faster Processors"),
+    (u"Senate Passes Tax Bill After Late-Night Vote",
+     u"Senate Passes Tax Bill After Late Night Vote"),
+    (u"The 10 Best Restaurants in Brooklyn Right Now",
+     u"City Council Approves Budget for Subway Repairs"),
+    (u"Ask HN: How do you organize your personal knowledge base?",
+     u"Show HN: A tiny Lisp interpreter written in 200 lines of C"),
+    (u"Review: The New Kindle Is Thinner, Lighter and Cheaper",
+     u"Review: The New Kindle is Thinner, Lighter, and Cheaper"),
+    (u"Gothamist: Police Investigate Fire at East Village Bar",
+     u"Weekend Weather: Sunny and Warm, Rain Expected Monday"),
+]
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--feed", dest="feed", default=None,
+            help="Pair up the titles of this feed's stories instead of the samples."),
+        make_option("-n", "--number", type="int", dest="number", default=1000),
+    )
+
+    def handle(self, *args, **options):
+        title_pairs = SAMPLE_TITLES
+        if options['feed']:
+            titles = [s.story_title for s in MStory.objects(story_feed_id=options['feed'])
+                                                   .only('story_title')[:50] if s.story_title]
+            title_pairs = [(a, b) for a in titles for b in titles]
+
+        def full():
+            for first, second in title_pairs:
+                levenshtein_distance(first, second) < 5
+        def bounded():
+            for first, second in title_pairs:
+                bounded_levenshtein_distance(first, second, 4) < 5
+
+        for first, second in title_pairs:
+            full_distance = levenshtein_distance(first, second)
+            assert bounded_levenshtein_distance(first, second, 4) == min(full_distance, 5)
+
+        full_seconds = timeit.Timer(full).timeit(options['number'])
+        bounded_seconds = timeit.Timer(bounded).timeit(options['number'])
+        comparisons = len(title_pairs) * options['number']
+
+        print " ---> %s title comparisons" % comparisons
+        print " ---> Full matrix:  %.3fs (%.1f us each)" % (full_seconds, full_seconds / comparisons * 1e6)
+        print " ---> Banded (k=4): %.3fs (%.1f us each)" % (bounded_seconds, bounded_seconds / comparisons * 1e6)
+        print " ---> Speedup: %.1fx" % (full_seconds / max(bounded_seconds, 1e-9))
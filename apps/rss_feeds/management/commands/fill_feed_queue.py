@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed
+from utils.feed_queue import get_feed_queue
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+        """
+        Backfills the fetch queue with every fetchable feed. task_feeds does
+        this itself the first time it runs, but run it on deploy so no feed
+        waits for that.
+        """
+        Feed.fill_feed_queue()
+        print " ---> %s feeds in the fetch queue" % len(get_feed_queue())
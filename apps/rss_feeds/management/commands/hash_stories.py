@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import Feed, MStory, NO_FINGERPRINT
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--feed", dest="feed", default=None),
+        make_option("-V", "--verbose", dest="verbose", action="store_true"),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Backfills story_guid_hash, story_permalink_hash and 
+        story_content_fingerprint on stored stories. Stories too short to
+        fingerprint get NO_FINGERPRINT, so they aren't selected again.
+        """
+        if options['feed']:
+            feeds = Feed.objects.filter(pk=options['feed'])
+        else:
+            feeds = Feed.objects.all()
+
+        hashed = 0
+        for feed in feeds:
+            feed_hashed = 0
+            stories = MStory.objects(story_feed_id=feed.pk, story_content_fingerprint__exists=False)\
+                            .only('story_guid', 'story_permalink', 'story_content', 'story_content_z')
+            for story in stories:
+                story.story_content = story.get_content()
+                story.hash_story()
+                MStory.objects(id=story.id).update_one(set__story_guid_hash=story.story_guid_hash,
+                                                       set__story_permalink_hash=story.story_permalink_hash,
+                                                       set__story_content_fingerprint=story.story_content_fingerprint or NO_FINGERPRINT)
+                feed_hashed += 1
+            hashed += feed_hashed
+            if options['verbose']:
+                print "  ---> %s [%s]: %s stories hashed" % (feed.feed_title, feed.pk, feed_hashed)
+
+        print "\nHashed %s stories" % hashed
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from apps.reader.models import UserSubscription, MReadStories
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-u", "--username", dest="username", nargs=1, help="Specify user id or username"),
+        make_option("-V", "--verbose", dest="verbose", action="store_true"),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Builds the MReadStories read state of every subscription that doesn't
+        have one yet from its MUserStory documents.
+        """
+        usersubs = UserSubscription.objects.all()
+        if options['username']:
+            user = User.objects.get(username__icontains=options['username'])
+            usersubs = usersubs.filter(user=user)
+
+        migrated = 0
+        for sub in usersubs.order_by('user'):
+            if MReadStories.objects(user_id=sub.user_id, feed_id=sub.feed_id).count():
+                continue
+            read_stories = MReadStories.migrate_from_userstories(sub.user_id, sub.feed_id)
+            migrated += 1
+            if options['verbose']:
+                print "  ---> [%s] %s: %s read stories" % (sub.user_id, sub.feed_id, len(read_stories))
+
+        print "\nMigrated %s subscriptions" % migrated
@@ -18,12 +18,28 @@ class Command(BaseCommand):
         make_option('-t', '--timeout', type='int', default=10,
             help='Wait timeout in seconds when connecting to feeds.'),
         make_option('-u', '--username', type='str', dest='username'),
+        make_option('-n', '--number', type='int', dest='number', default=10000,
+            help='Most due feeds to take from the fetch queue.'),
         make_option('-V', '--verbose', action='store_true',
             dest='verbose', default=False, help='Verbose output.'),
         make_option('-S', '--skip', type='int',
             dest='skip', default=0, help='Skip stories per month < #.'),
         make_option('-w', '--workerthreads', type='int', default=4,
             help='Worker threads that will fetch feeds in parallel.'),
+        make_option('-c', '--concurrency', type='int', dest='fetch_concurrency', default=0,
+            help='Feeds each worker keeps downloading concurrently (0 fetches one at a time).'),
+        make_option('-b', '--batch', type='int', dest='batch_size', default=0,
+            help='Load feeds in batches of this size, writing each feed once when done.'),
+        make_option('-p', '--pipeline', action='store_true', dest='pipeline', default=False,
+            help='Fetch, parse, write and post-process feeds in separate pipeline stages.'),
+        make_option('--parsers', type='int', dest='parsers', default=0,
+            help='Pipeline processes parsing feeds (defaults to one per CPU).'),
+        make_option('--writers', type='int', dest='writers', default=2,
+            help='Pipeline processes writing stories.'),
+        make_option('--postprocessors', type='int', dest='postprocessors', default=2,
+            help='Pipeline processes updating subscribers and pages.'),
+        make_option('--queuesize', type='int', dest='queue_size', default=100,
+            help='Feeds allowed to wait between two pipeline stages.'),
     )
 
     def handle(self, *args, **options):
@@ -45,35 +61,25 @@ class Command(BaseCommand):
             
         socket.setdefaulttimeout(options['timeout'])
         if options['force']:
-            feeds = Feed.objects.all()
+            feed_ids = list(Feed.objects.values_list('pk', flat=True))
         elif options['username']:
-            feeds = Feed.objects.filter(subscribers__user=User.objects.get(username=options['username']))
+            feed_ids = list(Feed.objects.filter(subscribers__user=User.objects.get(username=options['username']))
+                                        .values_list('pk', flat=True))
         else:
-            feeds = Feed.objects.filter(next_scheduled_update__lte=now, active=True)
+            feed_ids = Feed.pop_due_feeds(options['number'], now)
         
-        feeds = feeds.order_by('?')
+        # Due feeds are leased in the fetch queue, and each fetch reschedules
+        # its feed, so one UPDATE marks them all queued.
+        Feed.objects.filter(pk__in=feed_ids).update(queued_date=now)
         
-        for f in feeds:
-            f.queued_date = datetime.datetime.utcnow()
-            f.set_next_scheduled_update()
-        
-        num_workers = min(len(feeds), options['workerthreads'])
+        num_workers = min(len(feed_ids), options['workerthreads'])
         if options['single_threaded']:
             num_workers = 1
         
         options['compute_scores'] = True
         
         disp = feed_fetcher.Dispatcher(options, num_workers)        
+        disp.add_jobs(feed_ids)
         
-        feeds_queue = []
-        for _ in range(num_workers):
-            feeds_queue.append([])
-            
-        i = 0
-        for feed in feeds:
-            feeds_queue[i%num_workers].append(feed.pk)
-            i += 1
-        disp.add_jobs(feeds_queue, i)
-        
-        print " ---> Fetching %s feeds..." % feeds.count()
+        print " ---> Fetching %s feeds..." % len(feed_ids)
         disp.run_jobs()
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from apps.rss_feeds.models import MFeedSchedule
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--feed", dest="feed", default=None,
+            help="Only report on this feed."),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Compares the fetches scheduled from each feed's learned publishing
+        pattern ('adaptive') with those from the stories-per-month formula
+        ('decay'): how often they found new stories, how often that was
+        predicted, and how many fetches each new story cost.
+        """
+        schedules = MFeedSchedule.objects.only('fetch_stats')
+        if options['feed']:
+            schedules = schedules.filter(feed_id=int(options['feed']))
+
+        totals = {}
+        feeds = {}
+        for schedule in schedules:
+            for scheduler, stats in (schedule.fetch_stats or {}).items():
+                scheduler_totals = totals.setdefault(scheduler, dict(fetches=0, not_modified=0, hits=0,
+                                                                     stories=0, predicted=0.0))
+                for key, value in stats.items():
+                    scheduler_totals[key] += value
+                feeds[scheduler] = feeds.get(scheduler, 0) + 1
+
+        for scheduler in sorted(totals):
+            stats = totals[scheduler]
+            fetches = max(1, stats['fetches'])
+            print " ---> %s: %s feeds, %s fetches, %s new stories" % (
+                  scheduler, feeds[scheduler], stats['fetches'], stats['stories'])
+            print "      Hit rate:       %.1f%% (%s fetches found new stories)" % (
+                  100.0 * stats['hits'] / fetches, stats['hits'])
+            if scheduler == 'adaptive':
+                print "      Predicted rate: %.1f%%" % (100.0 * stats['predicted'] / fetches)
+            print "      Not modified:   %.1f%%" % (100.0 * stats['not_modified'] / fetches)
+            print "      Fetches per new story: %.2f" % (float(stats['fetches']) / max(1, stats['stories']))
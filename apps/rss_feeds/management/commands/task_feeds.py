@@ -9,6 +9,8 @@ class Command(BaseCommand):
         make_option("-f", "--feed", default=None),
         make_option('-V', '--verbose', action='store_true',
             dest='verbose', default=False, help='Verbose output.'),
+        make_option('-n', '--number', type='int', dest='number', default=10000,
+            help='Most feeds to task from the fetch queue.'),
     )
 
     def handle(self, *args, **options):
@@ -17,20 +19,15 @@ class Command(BaseCommand):
         now = datetime.datetime.utcnow()
         
         # Active feeds
-        feeds = Feed.objects.filter(
-            next_scheduled_update__lte=now,
-            active=True
-        ).exclude(
-            active_subscribers=0
-        ).order_by('?')
-        Feed.task_feeds(feeds)
+        feed_ids = Feed.pop_due_feeds(options['number'], now)
+        Feed.task_feeds(feed_ids)
         
         # Mistakenly inactive feeds
         week = now - datetime.timedelta(days=7)
         day = now - datetime.timedelta(days=1)
-        feeds = Feed.objects.filter(
+        feed_ids = list(Feed.objects.filter(
             last_update__lte=week, 
             queued_date__lte=day,
             active_subscribers__gte=1
-        ).order_by('?')
-        if feeds: Feed.task_feeds(feeds)
\ No newline at end of file
+        ).values_list('pk', flat=True))
+        if feed_ids: Feed.task_feeds(feed_ids)
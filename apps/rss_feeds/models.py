@@ -1,6 +1,7 @@
 import difflib
 import datetime
 import hashlib
+import math
 import random
 import re
 import mongoengine as mongo
@@ -16,18 +17,41 @@ from django.db import IntegrityError
 from django.core.cache import cache
 from django.conf import settings
 from mongoengine.queryset import OperationError
-from apps.rss_feeds.tasks import UpdateFeeds
+from mongoengine.base import ValidationError
+from apps.rss_feeds.tasks import UpdateFeeds, RepairFeeds
 from celery.task import Task
 from utils import json_functions as json
 from utils import feedfinder
-from utils.feed_functions import levenshtein_distance
-from utils.feed_functions import timelimit
+from utils.feed_functions import bounded_levenshtein_distance
+from utils.feed_functions import content_fingerprint, fingerprint_distance
+from utils.feed_functions import timelimit, check_deadline
+from utils.feed_queue import get_feed_queue
 from utils.story_functions import pre_process_story
+from utils.story_functions import encode_story_cursor, stories_after_cursor
 from utils.compressed_textfield import StoryField
 from utils.diff import HTMLDiff
 from utils import log as logging
 
 ENTRY_NEW, ENTRY_UPDATED, ENTRY_SAME, ENTRY_ERR = range(4)
+# Stories whose content fingerprints are further apart than this are assumed
+# to be different stories and aren't diffed in _exists_story. It's a heuristic:
+# a small edit to a fingerprinted story almost never moves this many bits, but
+# if it does the edited story is saved again as new rather than as an update.
+MAX_FINGERPRINT_DISTANCE = 16
+# Stored for stories too short to fingerprint, so hash_stories doesn't
+# pick them up again. Never compared, like a missing fingerprint.
+NO_FINGERPRINT = 0
+FORMATTED_STORY_CACHE_SECONDS = 60*60*24
+# Feed fields that subscribers' feed list snapshots are built from.
+SNAPSHOT_FIELDS = ('feed_title', 'feed_address', 'feed_link', 'active', 'fetched_once',
+                   'has_feed_exception', 'has_page_exception', 'exception_code', 'num_subscribers')
+# Feed fields that decide whether and when a feed is in the fetch queue.
+FEED_QUEUE_FIELDS = ('next_scheduled_update', 'active', 'active_subscribers')
+# Fetch schedules learned from each feed's own publishing, see MFeedSchedule.
+MIN_SCHEDULE_INTERVALS = 5
+MAX_SCHEDULE_INTERVALS = 50
+MIN_SCHEDULE_MINUTES = 6
+MAX_SCHEDULE_MINUTES = 60*24*2
 
 class Feed(models.Model):
     feed_address = models.URLField(max_length=255, verify_exists=True, unique=True)
@@ -57,6 +81,12 @@ class Feed(models.Model):
     popular_tags = models.CharField(max_length=1024, blank=True, null=True)
     popular_authors = models.CharField(max_length=2048, blank=True, null=True)
     
+    def __init__(self, *args, **kwargs):
+        super(Feed, self).__init__(*args, **kwargs)
+        # While defer_saves is set, save() only keeps changes in memory and
+        # flush() writes the changed columns in a single UPDATE.
+        self.defer_saves = False
+        self.mark_clean()
     
     def __unicode__(self):
         if not self.feed_title:
@@ -74,35 +104,119 @@ class Feed(models.Model):
         if not self.queued_date:
             self.queued_date = datetime.datetime.utcnow()
         
+        if self.defer_saves and self.pk:
+            return
 
+        is_new = not self.pk
+        dirty_fields = not is_new and self.dirty_fields()
         try:
             super(Feed, self).save(*args, **kwargs)
+            self.mark_clean()
+            if dirty_fields:
+                self.expire_subscriber_snapshots(dirty_fields)
+            if is_new or dirty_fields:
+                self.update_feed_queue(FEED_QUEUE_FIELDS if is_new else dirty_fields)
         except IntegrityError, e:
-            duplicate_feed = Feed.objects.filter(feed_address=self.feed_address)
-            logging.debug("%s: %s" % (self.feed_address, duplicate_feed))
-            logging.debug(' ***> [%-30s] Feed deleted. Could not save: %s' % (self, e))
-            if duplicate_feed:
-                merge_feeds(self.pk, duplicate_feed[0].pk)
-                return duplicate_feed[0].pk
-            # Feed has been deleted. Just ignore it.
-            pass
+            return self.merge_into_duplicate(e)
+    
+    def flush(self):
+        """
+        Writes only the fields changed since the feed was loaded or last
+        written, as one UPDATE. Returns the number of fields written.
+        """
+        dirty_fields = self.dirty_fields()
+        if not dirty_fields:
+            return 0
+        
+        try:
+            Feed.objects.filter(pk=self.pk).update(**dirty_fields)
+        except IntegrityError, e:
+            self.merge_into_duplicate(e)
+        self.mark_clean()
+        self.expire_subscriber_snapshots(dirty_fields)
+        self.update_feed_queue(dirty_fields)
+        return len(dirty_fields)
+    
+    def update_feed_queue(self, dirty_fields):
+        if not any(field in dirty_fields for field in FEED_QUEUE_FIELDS):
+            return
+        if self.active and self.active_subscribers != 0:
+            get_feed_queue().schedule({self.pk: self.next_scheduled_update})
+        else:
+            get_feed_queue().remove([self.pk])
+    
+    def expire_subscriber_snapshots(self, dirty_fields):
+        if not any(field in dirty_fields for field in SNAPSHOT_FIELDS):
+            return
+        from apps.reader.models import invalidate_feeds_snapshot
+        for user_id in self.subscribers.values_list('user', flat=True):
+            invalidate_feeds_snapshot(user_id)
+    
+    def field_values(self):
+        return dict((field.attname, getattr(self, field.attname)) 
+                    for field in self._meta.fields)
+    
+    def dirty_fields(self):
+        return dict((name, value) for name, value in self.field_values().items()
+                    if self._clean_values.get(name) != value)
+    
+    def mark_clean(self):
+        self._clean_values = self.field_values()
+    
+    def merge_into_duplicate(self, e):
+        duplicate_feed = Feed.objects.filter(feed_address=self.feed_address)
+        logging.debug("%s: %s" % (self.feed_address, duplicate_feed))
+        logging.debug(' ***> [%-30s] Feed deleted. Could not save: %s' % (self, e))
+        if duplicate_feed:
+            merge_feeds(self.pk, duplicate_feed[0].pk)
+            return duplicate_feed[0].pk
+        # Feed has been deleted. Just ignore it.
     
     @classmethod
-    def task_feeds(cls, feeds, queue_size=12):
-        print " ---> Tasking %s feeds..." % feeds.count()
+    def task_feeds(cls, feed_ids, queue_size=12):
+        print " ---> Tasking %s feeds..." % len(feed_ids)
         
         publisher = Task.get_publisher()
 
-        feed_queue = []
-        for f in feeds:
-            f.queued_date = datetime.datetime.utcnow()
-            f.set_next_scheduled_update()
+        # Already leased in the fetch queue, so one UPDATE marks them all queued.
+        Feed.objects.filter(pk__in=feed_ids).update(queued_date=datetime.datetime.utcnow())
 
-        for feed_queue in (feeds[pos:pos + queue_size] for pos in xrange(0, len(feeds), queue_size)):
-            feed_ids = [feed.pk for feed in feed_queue]
-            UpdateFeeds.apply_async(args=(feed_ids,), queue='update_feeds', publisher=publisher)
+        for feed_queue in (feed_ids[pos:pos + queue_size] for pos in xrange(0, len(feed_ids), queue_size)):
+            UpdateFeeds.apply_async(args=(feed_queue,), queue='update_feeds', publisher=publisher)
 
         publisher.connection.close()
+    
+    @classmethod
+    def pop_due_feeds(cls, limit, now=None):
+        """
+        Takes up to `limit` of the feeds due for a fetch off the fetch queue,
+        soonest due first. They stay leased in the queue until fetching them
+        reschedules them. Feeds that have been deleted, deactivated or lost
+        their subscribers since they were queued are dropped from it.
+        """
+        now = now or datetime.datetime.utcnow()
+        feed_queue = get_feed_queue()
+        if not feed_queue.is_filled():
+            cls.fill_feed_queue()
+        
+        feed_ids = feed_queue.pop_due(now, limit)
+        if not feed_ids:
+            return []
+        fetchable_ids = set(Feed.objects.filter(pk__in=feed_ids, active=True)
+                                        .exclude(active_subscribers=0)
+                                        .values_list('pk', flat=True))
+        feed_queue.remove([feed_id for feed_id in feed_ids if feed_id not in fetchable_ids])
+        return [feed_id for feed_id in feed_ids if feed_id in fetchable_ids]
+    
+    @classmethod
+    def fill_feed_queue(cls):
+        """
+        Adds every fetchable feed that isn't in the fetch queue yet, from one
+        query, and marks the queue filled. Feeds queued by saves before the
+        first fill keep their entries.
+        """
+        feeds = Feed.objects.filter(active=True).exclude(active_subscribers=0)
+        get_feed_queue().fill(dict(feeds.values_list('pk', 'next_scheduled_update')))
 
     def update_all_statistics(self):
         self.count_subscribers()
@@ -121,6 +235,7 @@ class Feed(models.Model):
         if not feedfinder.isFeed(self.feed_address):
             feed_address = feedfinder.feed(self.feed_address)
             if not feed_address:
+                check_deadline()
                 feed_address = feedfinder.feed(self.feed_link)
         else:
             feed_address_from_link = feedfinder.feed(self.feed_link)
@@ -334,20 +449,33 @@ class Feed(models.Model):
             'compute_scores': compute_scores,
         }
         disp = feed_fetcher.Dispatcher(options, 1)        
-        disp.add_jobs([[self.pk]])
+        disp.add_jobs([self.pk])
         disp.run_jobs()
 
     def add_update_stories(self, stories, existing_stories):
-        ret_values = {
-            ENTRY_NEW:0,
-            ENTRY_UPDATED:0,
-            ENTRY_SAME:0,
-            ENTRY_ERR:0
-        }
+        story_writes = self.match_stories(stories, existing_stories)
+        return self.write_stories(story_writes)
+    
+    def match_stories(self, stories, existing_stories):
+        """
+        Compares fetched stories against existing stories, without writing
+        anything. Returns a list of (entry type, existing story id, story
+        fields) for `write_stories`. Only plain data, so that matching and
+        writing can run in different processes.
+        
+        Stories are first matched exactly on their guid hash, or on their
+        permalink hash within the same 8 hour window as `_exists_story`, since
+        unrelated entries can share a link. Only the rest are fuzzy matched 
+        against `existing_stories`, which is never queried if everything 
+        matched exactly. An existing story is matched to one entry at most.
+        """
+        story_writes = []
+        new_story_guids = set()
+        matched_story_ids = set()
+        stories = [pre_process_story(story) for story in stories]
+        stories_by_guid_hash, stories_by_permalink_hash = self.find_exact_stories(stories)
         
         for story in stories:
-            story = pre_process_story(story)
-            
             if story.get('title'):
                 story_contents = story.get('content')
                 story_tags = self.get_tags(story)
@@ -356,25 +484,39 @@ class Feed(models.Model):
                     story_content = story_contents[0]['value']
                 else:
                     story_content = story.get('summary')
-                    
-                existing_story, story_has_changed = self._exists_story(story, story_content, existing_stories)
+                story_guid = story.get('guid') or story.get('id') or story.get('link')
+                
+                existing_story = stories_by_guid_hash.get(MStory.hash_guid(story_guid))
+                if not existing_story:
+                    existing_story = stories_by_permalink_hash.get(MStory.hash_guid(story.get('link')))
+                    if existing_story and not self._in_match_window(story, existing_story):
+                        existing_story = None
+                if existing_story:
+                    story_has_changed = (story.get('title') != existing_story.story_title or
+                                         story_content != existing_story.get_content())
+                else:
+                    existing_story, story_has_changed = self._exists_story(story, story_content, existing_stories)
+                if existing_story and existing_story.id in matched_story_ids:
+                    # An earlier entry in this fetch already matched it.
+                    existing_story = None
+                if existing_story:
+                    matched_story_ids.add(existing_story.id)
                 if existing_story is None:
-                    s = MStory(story_feed_id = self.pk,
-                           story_date = story.get('published'),
-                           story_title = story.get('title'),
-                           story_content = story_content,
-                           story_author_name = story.get('author'),
-                           story_permalink = story.get('link'),
-                           story_guid = story.get('guid') or story.get('id') or story.get('link'),
-                           story_tags = story_tags
-                    )
-                    try:
-                        s.save()
-                        ret_values[ENTRY_NEW] += 1
-                        cache.set('updated_feed:%s' % self.id, 1)
-                    except (IntegrityError, OperationError):
-                        ret_values[ENTRY_ERR] += 1
-                        # logging.info('Saving new story, IntegrityError: %s - %s: %s' % (self.feed_title, story.get('title'), e))
+                    if story_guid in new_story_guids:
+                        # Saving it again would fail, which counted as an error.
+                        story_writes.append((ENTRY_ERR, None, None))
+                        continue
+                    new_story_guids.add(story_guid)
+                    story_writes.append((ENTRY_NEW, None, dict(
+                        story_feed_id = self.pk,
+                        story_date = story.get('published'),
+                        story_title = story.get('title'),
+                        story_content = story_content,
+                        story_author_name = story.get('author'),
+                        story_permalink = story.get('link'),
+                        story_guid = story_guid,
+                        story_tags = story_tags
+                    )))
                 elif existing_story and story_has_changed:
                     # update story
                     # logging.debug('- Updated story in feed (%s - %s): %s / %s' % (self.feed_title, story.get('title'), len(existing_story.story_content), len(story_content)))
@@ -396,28 +538,137 @@ class Feed(models.Model):
                         # logging.debug('\tExisting title / New: : \n\t\t- %s\n\t\t- %s' % (existing_story.story_title, story.get('title')))
                         pass
 
-                    existing_story.story_feed = self.pk
-                    existing_story.story_date = story.get('published')
-                    existing_story.story_title = story.get('title')
-                    existing_story.story_content = story_content_diff
-                    existing_story.story_original_content = original_content
-                    existing_story.story_author_name = story.get('author')
-                    existing_story.story_permalink = story.get('link')
-                    existing_story.story_guid = story.get('guid') or story.get('id') or story.get('link')
-                    existing_story.story_tags = story_tags
-                    try:
-                        existing_story.save()
-                        ret_values[ENTRY_UPDATED] += 1
-                        cache.set('updated_feed:%s' % self.id, 1)
-                    except (IntegrityError, OperationError):
-                        ret_values[ENTRY_ERR] += 1
-                        logging.info('Saving updated story, IntegrityError: %s - %s' % (self.feed_title, story.get('title')))
+                    story_writes.append((ENTRY_UPDATED, existing_story.id, dict(
+                        story_feed_id = existing_story.story_feed_id,
+                        story_date = story.get('published'),
+                        story_title = story.get('title'),
+                        story_content = story_content_diff,
+                        story_original_content = original_content,
+                        story_content_type = existing_story.story_content_type,
+                        story_author_name = story.get('author'),
+                        story_permalink = story.get('link'),
+                        story_guid = story_guid,
+                        story_tags = story_tags
+                    )))
                 else:
-                    ret_values[ENTRY_SAME] += 1
+                    story_writes.append((ENTRY_SAME, None, None))
                     # logging.debug("Unchanged story: %s " % story.get('title'))
             
-        return ret_values
+        return story_writes
+    
+    def _in_match_window(self, story, existing_story):
+        if story.get('published_now', False):
+            return True
+        story_pub_date = story.get('published')
+        return (story_pub_date - datetime.timedelta(hours=8) < existing_story.story_date <
+                story_pub_date + datetime.timedelta(hours=8))
+    
+    def find_exact_stories(self, stories):
+        """
+        Looks up this feed's stored stories by the guid and permalink hashes
+        of incoming stories. Returns them keyed by each of the two hashes.
+        """
+        guid_hashes = set()
+        permalink_hashes = set()
+        for story in stories:
+            guid_hashes.add(MStory.hash_guid(story.get('guid') or story.get('id') or story.get('link')))
+            permalink_hashes.add(MStory.hash_guid(story.get('link')))
+        guid_hashes.discard(None)
+        permalink_hashes.discard(None)
+        
+        stories_by_guid_hash = {}
+        stories_by_permalink_hash = {}
+        if guid_hashes:
+            for existing_story in MStory.objects(story_feed_id=self.pk, 
+                                                 story_guid_hash__in=list(guid_hashes)):
+                stories_by_guid_hash[existing_story.story_guid_hash] = existing_story
+        if permalink_hashes:
+            for existing_story in MStory.objects(story_feed_id=self.pk,
+                                                 story_permalink_hash__in=list(permalink_hashes)):
+                stories_by_permalink_hash[existing_story.story_permalink_hash] = existing_story
+        
+        return stories_by_guid_hash, stories_by_permalink_hash
         
+    def write_stories(self, story_writes):
+        """
+        Writes all of a feed's new stories in one bulk insert, then its
+        updated stories, and marks the feed as updated once. If the bulk
+        insert fails, its stories are saved one by one so that the error
+        count stays exact. Re-saving by _id can't duplicate stories that did
+        make it in.
+        
+        The stories that were inserted are kept on `self.new_stories`, so
+        that subscribers' unread counts can be bumped by just those.
+        """
+        ret_values = {
+            ENTRY_NEW:0,
+            ENTRY_UPDATED:0,
+            ENTRY_SAME:0,
+            ENTRY_ERR:0
+        }
+        new_stories = []
+        updated_stories = []
+        
+        for entry_type, story_id, story_fields in story_writes:
+            if entry_type in (ENTRY_SAME, ENTRY_ERR):
+                ret_values[entry_type] += 1
+                continue
+            
+            s = MStory(**story_fields)
+            if story_id:
+                s.id = story_id
+            s.hash_story()
+            s.compress_content()
+            try:
+                s.validate()
+            except ValidationError, e:
+                # Only this story is lost, as when it was saved on its own.
+                ret_values[ENTRY_ERR] += 1
+                logging.info('Invalid story: %s - %s: %s' % (self.feed_title, story_fields.get('story_title'), e))
+                continue
+            if entry_type == ENTRY_NEW:
+                new_stories.append((s, s.to_mongo()))
+            else:
+                updated_stories.append(s.to_mongo())
+        
+        self.new_stories = []
+        stories_db = MStory.objects._collection
+        if new_stories:
+            try:
+                stories_db.insert([story for _, story in new_stories], safe=True)
+                ret_values[ENTRY_NEW] += len(new_stories)
+                self.new_stories = [s for s, _ in new_stories]
+            except pymongo.errors.OperationFailure:
+                for s, story in new_stories:
+                    try:
+                        stories_db.save(story, safe=True)
+                        ret_values[ENTRY_NEW] += 1
+                        self.new_stories.append(s)
+                    except pymongo.errors.OperationFailure:
+                        ret_values[ENTRY_ERR] += 1
+            for s, story in new_stories:
+                s.id = story.get('_id')
+
+        if updated_stories:
+            # Updated stories get new formatted entries, so drop the old ones.
+            old_stories = MStory.objects(id__in=[story['_id'] for story in updated_stories])
+            for old_story in old_stories:
+                cache.delete(Feed.formatted_story_key(old_story, self.pk))
+        
+        for story in updated_stories:
+            try:
+                stories_db.save(story, safe=True)
+                ret_values[ENTRY_UPDATED] += 1
+            except pymongo.errors.OperationFailure:
+                ret_values[ENTRY_ERR] += 1
+                logging.info('Saving updated story, IntegrityError: %s - %s' % (self.feed_title, story.get('story_title')))
+        
+        if ret_values[ENTRY_NEW] or ret_values[ENTRY_UPDATED]:
+            cache.set('updated_feed:%s' % self.id, 1)
+            self.expire_stories_cache(added=ret_values[ENTRY_NEW], updated=ret_values[ENTRY_UPDATED])
+            
+        return ret_values
+    
     def save_popular_tags(self, feed_tags=None):
         if not feed_tags:
             try:
@@ -488,36 +739,90 @@ class Feed(models.Model):
                 # print "Found %s user stories. Deleting..." % userstories.count()
                 userstories.delete()
         
-    def get_stories(self, offset=0, limit=25, force=False):
-        stories = cache.get('feed_stories:%s-%s-%s' % (self.id, offset, limit), [])
+    def get_stories(self, limit=25, cursor=None, force=False):
+        """
+        Returns a page of stories after `cursor`, newest first, and the cursor
+        for the page after it. 
+        
+        Pages are cached by feed and cursor. New stories only change the first
+        page, so pages further down stay cached until a story is updated.
+        """
+        updated_version, added_version = cache.get('feed_stories_version:%s' % self.pk, (0, 0))
+        cache_key = 'feed_stories:%s:%s:%s:%s' % (self.pk, updated_version, limit,
+                                                  cursor or 'latest:%s' % added_version)
+        page = cache.get(cache_key)
         
-        if not stories or force:
-            stories_db = MStory.objects(story_feed_id=self.pk)[offset:offset+limit]
+        if page is None or force:
+            stories_db = MStory.objects(story_feed_id=self.pk)
+            stories_db = list(stories_after_cursor(stories_db, cursor)[:limit])
             stories = Feed.format_stories(stories_db, self.pk)
-            cache.set('feed_stories:%s-%s-%s' % (self.id, offset, limit), stories)
+            next_cursor = stories_db and encode_story_cursor(stories_db[-1].story_date, 
+                                                             stories_db[-1].id) or cursor
+            page = (stories, next_cursor)
+            cache.set(cache_key, page)
         
-        return stories
+        return page
+    
+    def expire_stories_cache(self, added=False, updated=False):
+        updated_version, added_version = cache.get('feed_stories_version:%s' % self.pk, (0, 0))
+        cache.set('feed_stories_version:%s' % self.pk, (updated_version + int(bool(updated)),
+                                                        added_version + int(bool(added))))
     
     @classmethod
     def format_stories(cls, stories_db, feed_id=None):
+        """
+        Formatted stories come from a cache shared by every view and by 
+        scoring, so each story's content is only decompressed once. 
+        """
+        stories_db = list(stories_db)
+        cache_keys = [cls.formatted_story_key(story_db, feed_id) for story_db in stories_db]
+        cached_stories = cache.get_many(cache_keys) if cache_keys else {}
         stories = []
 
-        for story_db in stories_db:
-            story = {}
-            story['story_tags'] = story_db.story_tags or []
-            story['story_date'] = story_db.story_date
-            story['story_authors'] = story_db.story_author_name
-            story['story_title'] = story_db.story_title
-            story['story_content'] = story_db.story_content_z and zlib.decompress(story_db.story_content_z)
-            story['story_permalink'] = urllib.unquote(urllib.unquote(story_db.story_permalink))
-            story['story_feed_id'] = feed_id or story_db.story_feed_id
-            story['id'] = story_db.story_guid
+        for story_db, cache_key in zip(stories_db, cache_keys):
+            story = cached_stories.get(cache_key)
+            if story is None:
+                story = cls.format_story(story_db, feed_id)
+                cache.set(cache_key, story, FORMATTED_STORY_CACHE_SECONDS)
             if hasattr(story_db, 'starred_date'):
                 story['starred_date'] = story_db.starred_date
             
             stories.append(story)
             
         return stories
+    
+    @classmethod
+    def format_story(cls, story_db, feed_id=None):
+        story = {}
+        story['story_tags'] = story_db.story_tags or []
+        story['story_date'] = story_db.story_date
+        story['story_authors'] = story_db.story_author_name
+        story['story_title'] = story_db.story_title
+        story['story_content'] = story_db.story_content_z and zlib.decompress(story_db.story_content_z)
+        story['story_permalink'] = urllib.unquote(urllib.unquote(story_db.story_permalink))
+        story['story_feed_id'] = feed_id or story_db.story_feed_id
+        story['id'] = story_db.story_guid
+        
+        return story
+    
+    @classmethod
+    def formatted_story_key(cls, story_db, feed_id=None):
+        """
+        Keyed by feed, guid and a hash of everything that's formatted, so an 
+        edited story never matches its old entry. The content is hashed 
+        compressed, which is cheaper than decompressing it.
+        """
+        story_guid_hash = getattr(story_db, 'story_guid_hash', None) or MStory.hash_guid(story_db.story_guid)
+        content_hash = hashlib.md5()
+        for value in (story_db.story_title, story_db.story_permalink, story_db.story_author_name,
+                      u'\x00'.join(story_db.story_tags or []), unicode(story_db.story_date)):
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            content_hash.update((value or '') + '\x00')
+        content_hash.update(story_db.story_content_z or '')
+        
+        return 'formatted_story:%s:%s:%s' % (feed_id or story_db.story_feed_id, story_guid_hash,
+                                             content_hash.hexdigest())
         
     def get_tags(self, entry):
         fcat = []
@@ -551,6 +856,7 @@ class Feed(models.Model):
         story_published_now = story.get('published_now', False)
         start_date = story_pub_date - datetime.timedelta(hours=8)
         end_date = story_pub_date + datetime.timedelta(hours=8)
+        story_fingerprint = content_fingerprint(story_content)
         existing_stories.rewind()
         
         for existing_story in existing_stories:
@@ -567,8 +873,19 @@ class Feed(models.Model):
                     story_in_system = existing_story
                 
                 # Title distance + content distance, checking if story changed
-                story_title_difference = levenshtein_distance(story.get('title'),
-                                                              existing_story.story_title)
+                # Only distances under 5 count, so stop computing past that.
+                story_title_difference = bounded_levenshtein_distance(story.get('title'),
+                                                                      existing_story.story_title or u'',
+                                                                      4)
+                
+                # Skip the full diff when fingerprints show the content differs.
+                existing_fingerprint = existing_story.story_content_fingerprint
+                if (not story_in_system and 
+                    story_fingerprint and 
+                    existing_fingerprint and
+                    fingerprint_distance(story_fingerprint, existing_fingerprint) > MAX_FINGERPRINT_DISTANCE):
+                    continue
+                
                 if 'story_content_z' in existing_story:
                     existing_story_content = unicode(zlib.decompress(existing_story.story_content_z))
                 elif 'story_content' in existing_story:
@@ -612,6 +929,14 @@ class Feed(models.Model):
         if self.min_to_decay and not force:
             random_factor = random.randint(0, self.min_to_decay) / 4
             return self.min_to_decay, random_factor
+        
+        # Feeds that have published enough are fetched when their next story
+        # is likely to be up, with only a little jitter.
+        schedule = self.publish_schedule()
+        total = schedule and schedule.next_update_minutes(datetime.datetime.utcnow())
+        if total:
+            random_factor = random.randint(0, total) / 10
+            return total, random_factor
             
         # Use stories per month to calculate next feed update
         updates_per_day = self.stories_last_month / 30.0
@@ -654,7 +979,7 @@ class Feed(models.Model):
         
         return total, random_factor
         
-    def set_next_scheduled_update(self):
+    def set_next_scheduled_update(self, save=True):
         total, random_factor = self.get_next_scheduled_update(force=True)
         
         next_scheduled_update = datetime.datetime.utcnow() + datetime.timedelta(
@@ -663,12 +988,40 @@ class Feed(models.Model):
         self.min_to_decay = total
         self.next_scheduled_update = next_scheduled_update
 
-        self.save()
+        if save:
+            self.save()
+    
+    def publish_schedule(self):
+        if not hasattr(self, '_publish_schedule'):
+            self._publish_schedule = MFeedSchedule.objects(feed_id=self.pk).first()
+        return self._publish_schedule
+    
+    def record_fetch(self, not_modified=False, new_stories=None):
+        """
+        Teaches the feed's schedule about a finished fetch, then schedules the
+        next one from it. Leaves saving the feed to the caller.
+        """
+        schedule = self.publish_schedule() or MFeedSchedule(feed_id=self.pk)
+        schedule.record_fetch(datetime.datetime.utcnow(), not_modified,
+                              [story.story_date for story in new_stories or [] if story.story_date])
+        schedule.save()
+        self._publish_schedule = schedule
+        self.set_next_scheduled_update(save=False)
 
     def schedule_feed_fetch_immediately(self):
         self.next_scheduled_update = datetime.datetime.utcnow()
 
         self.save()
+    
+    @classmethod
+    def queue_repair(cls, feeds):
+        """
+        Recounts subscribers and refetches inactive feeds on a background 
+        worker. Each feed is queued at most once an hour.
+        """
+        feed_ids = [feed.pk for feed in feeds if cache.add('repair_feed:%s' % feed.pk, 1, 60*60)]
+        if feed_ids:
+            RepairFeeds.apply_async(args=(feed_ids,))
         
     def calculate_collocations_story_content(self,
                                              collocation_measures=TrigramAssocMeasures,
@@ -799,23 +1152,51 @@ class MStory(mongo.Document):
     story_author_name        = mongo.StringField()
     story_permalink          = mongo.StringField()
     story_guid               = mongo.StringField()
+    story_guid_hash          = mongo.StringField(max_length=32)
+    story_permalink_hash     = mongo.StringField(max_length=32)
+    story_content_fingerprint = mongo.IntField()
     story_tags               = mongo.ListField(mongo.StringField(max_length=250))
 
     meta = {
         'collection': 'stories',
-        'indexes': ['story_date', ('story_feed_id', '-story_date')],
+        'indexes': ['story_date', ('story_feed_id', '-story_date'),
+                    ('story_feed_id', 'story_guid_hash'),
+                    ('story_feed_id', 'story_permalink_hash')],
         'ordering': ['-story_date'],
         'allow_inheritance': False,
     }
     
     def save(self, *args, **kwargs):
+        self.hash_story()
+        self.compress_content()
+        super(MStory, self).save(*args, **kwargs)
+    
+    @staticmethod
+    def hash_guid(guid):
+        if not guid:
+            return None
+        if isinstance(guid, unicode):
+            guid = guid.encode('utf-8')
+        return hashlib.md5(guid).hexdigest()
+    
+    def hash_story(self):
+        self.story_guid_hash = self.hash_guid(self.story_guid)
+        self.story_permalink_hash = self.hash_guid(self.story_permalink)
+        if self.story_content:
+            self.story_content_fingerprint = content_fingerprint(self.story_content) or NO_FINGERPRINT
+    
+    def get_content(self):
+        if self.story_content_z:
+            return unicode(zlib.decompress(self.story_content_z))
+        return self.story_content or u''
+    
+    def compress_content(self):
         if self.story_content:
             self.story_content_z = zlib.compress(self.story_content)
             self.story_content = None
         if self.story_original_content:
             self.story_original_content_z = zlib.compress(self.story_original_content)
             self.story_original_content = None
-        super(MStory, self).save(*args, **kwargs)
 
 
 class MStarredStory(mongo.Document):
@@ -858,6 +1239,7 @@ class FeedUpdateHistory(models.Model):
     number_of_feeds = models.IntegerField()
     seconds_taken = models.IntegerField()
     average_per_feed = models.DecimalField(decimal_places=1, max_digits=4)
+    worker_utilisation = models.TextField(null=True, blank=True)
     
     def __unicode__(self):
         return "[%s] %s feeds: %s seconds" % (
@@ -945,6 +1327,148 @@ class MPageFetchHistory(mongo.Document):
         super(MPageFetchHistory, self).save(*args, **kwargs)
 
 
+class MFeedSchedule(mongo.Document):
+    """
+    What a feed's fetches have shown about when it publishes: the gaps 
+    between its recent stories, which hours and weekdays they come out on, 
+    and how often fetches came back empty or 304. 
+    
+    Fetches are tallied under the scheduler that would have picked them, 
+    'adaptive' once there are enough gaps to predict from and 'decay' (the
+    stories-per-month formula) before that, along with the chance of new 
+    stories predicted for each, so the two can be compared.
+    """
+    feed_id = mongo.IntField(primary_key=True)
+    intervals = mongo.ListField(mongo.IntField())
+    hour_counts = mongo.ListField(mongo.IntField())
+    weekday_counts = mongo.ListField(mongo.IntField())
+    last_story_date = mongo.DateTimeField()
+    last_fetch_date = mongo.DateTimeField()
+    fetch_stats = mongo.DictField()
+    
+    meta = {
+        'collection': 'feed_schedules',
+        'allow_inheritance': False,
+    }
+    
+    def record_fetch(self, fetch_date, not_modified=False, story_dates=None):
+        story_dates = story_dates or []
+        scheduler = 'adaptive' if self.story_rate() else 'decay'
+        self.fetch_stats = self.fetch_stats or {}
+        stats = self.fetch_stats.setdefault(scheduler, dict(fetches=0, not_modified=0, hits=0,
+                                                            stories=0, predicted=0.0))
+        stats['fetches'] += 1
+        stats['not_modified'] += int(bool(not_modified))
+        stats['hits'] += int(bool(story_dates))
+        stats['stories'] += len(story_dates)
+        if scheduler == 'adaptive' and self.last_fetch_date:
+            stats['predicted'] += self.hit_probability(self.last_fetch_date, fetch_date)
+        
+        self.intervals = self.intervals or []
+        self.hour_counts = self.hour_counts or [0] * 24
+        self.weekday_counts = self.weekday_counts or [0] * 7
+        
+        # Only stories dated since the last fetch say when the feed publishes.
+        # The first fetch's stories are a backlog, and backdated stories 
+        # would skew the histograms.
+        for story_date in sorted(story_dates):
+            if not self.last_fetch_date or not (self.last_fetch_date < story_date <= fetch_date):
+                continue
+            if self.last_story_date:
+                if story_date < self.last_story_date:
+                    continue
+                self.intervals.append(int(minutes_between(self.last_story_date, story_date)))
+            self.hour_counts[story_date.hour] += 1
+            self.weekday_counts[story_date.weekday()] += 1
+            self.last_story_date = story_date
+        self.intervals = self.intervals[-MAX_SCHEDULE_INTERVALS:]
+        
+        if story_dates and not self.last_story_date:
+            self.last_story_date = min(max(story_dates), fetch_date)
+        self.last_fetch_date = fetch_date
+    
+    def story_rate(self, date=None):
+        """
+        Stories expected per minute: one per mean gap between recent stories,
+        slowed down for a feed that has gone quiet for much longer than that.
+        """
+        if not self.intervals or len(self.intervals) < MIN_SCHEDULE_INTERVALS:
+            return None
+        mean_interval = max(1.0, sum(self.intervals) / float(len(self.intervals)))
+        rate = 1 / mean_interval
+        if date and self.last_story_date:
+            quiet_minutes = minutes_between(self.last_story_date, date)
+            rate *= min(1.0, 2 * mean_interval / max(1, quiet_minutes))
+        
+        # Keep predictions honest by scaling them with how the adaptive 
+        # fetches have actually done against what was predicted for them.
+        stats = (self.fetch_stats or {}).get('adaptive')
+        if stats:
+            rate *= min(2.0, max(0.5, (stats['hits'] + 1) / (stats['predicted'] + 1)))
+        return rate
+    
+    def time_weight(self, date):
+        """
+        How much busier this hour and weekday are than average. Smoothed 
+        towards even, weekdays more so as they take weeks to fill in.
+        """
+        if not self.hour_counts:
+            return 1.0
+        hours = sum(self.hour_counts)
+        weekdays = sum(self.weekday_counts)
+        return (24 * (self.hour_counts[date.hour] + 2.0) / (hours + 2 * 24) *
+                7 * (self.weekday_counts[date.weekday()] + 10.0) / (weekdays + 10 * 7))
+    
+    def expected_stories(self, start, end, until=None):
+        """
+        Stories expected between `start` and `end`, an hour at a time. With
+        `until`, returns instead the minutes after `start` by which that many
+        stories are expected, or None if not by `end`.
+        """
+        rate = self.story_rate(start)
+        expected = 0.0
+        date = start
+        while date < end:
+            next_hour = date.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+            slice_end = min(end, next_hour)
+            slice_rate = rate * self.time_weight(date)
+            slice_stories = slice_rate * minutes_between(date, slice_end)
+            if until is not None and expected + slice_stories >= until:
+                return minutes_between(start, date) + (until - expected) / slice_rate
+            expected += slice_stories
+            date = slice_end
+        if until is not None:
+            return None
+        return expected
+    
+    def hit_probability(self, start, end):
+        """Chance that a fetch at `end`, after one at `start`, finds new stories."""
+        return 1 - math.exp(-self.expected_stories(start, end))
+    
+    def next_update_minutes(self, date):
+        """
+        Minutes from `date` until a fetch is more likely than not to find new
+        stories, or None without enough history. Feeds that mostly answer 
+        304s are cheap to check, so they're fetched a little earlier.
+        """
+        if not self.story_rate(date):
+            return None
+        fetch_stats = (self.fetch_stats or {}).values()
+        fetches = sum(stats['fetches'] for stats in fetch_stats)
+        not_modified = sum(stats['not_modified'] for stats in fetch_stats)
+        target = 0.35 if not_modified * 2 > fetches else 0.5
+        
+        end = date + datetime.timedelta(minutes=MAX_SCHEDULE_MINUTES)
+        minutes = self.expected_stories(date, end, until=-math.log(1 - target))
+        if minutes is None:
+            return MAX_SCHEDULE_MINUTES
+        return max(MIN_SCHEDULE_MINUTES, int(minutes))
+
+
+def minutes_between(start, end):
+    delta = end - start
+    return delta.days * 24 * 60 + delta.seconds / 60.0
+
 class FeedLoadtime(models.Model):
     feed = models.ForeignKey(Feed)
     date_accessed = models.DateTimeField(auto_now=True)
@@ -959,8 +1483,9 @@ class DuplicateFeed(models.Model):
     feed = models.ForeignKey(Feed, related_name='duplicate_addresses')
 
 def merge_feeds(original_feed_id, duplicate_feed_id, force=False):
-    from apps.reader.models import UserSubscription, UserSubscriptionFolders, MUserStory
+    from apps.reader.models import UserSubscription, UserSubscriptionFolders, MUserStory, MReadStories
     from apps.analyzer.models import MClassifierTitle, MClassifierAuthor, MClassifierFeed, MClassifierTag
+    from apps.analyzer.models import invalidate_classifiers
     if original_feed_id > duplicate_feed_id and not force:
         original_feed_id, duplicate_feed_id = duplicate_feed_id, original_feed_id
     try:
@@ -1003,21 +1528,26 @@ def merge_feeds(original_feed_id, duplicate_feed_id, force=False):
     logging.info(" ---> %s read stories" % user_stories.count())
     for user_story in user_stories:
         user_story.feed_id = original_feed.pk
-        duplicate_story = user_story.story
-        story_guid = duplicate_story.story_guid if hasattr(duplicate_story, 'story_guid') else duplicate_story.id
+        story_guid = user_story.story_guid
+        if not story_guid:
+            duplicate_story = user_story.story
+            story_guid = duplicate_story.story_guid if hasattr(duplicate_story, 'story_guid') else duplicate_story.id
         original_story = MStory.objects(story_feed_id=original_feed.pk,
                                         story_guid=story_guid)
         
         if original_story:
             user_story.story = original_story[0]
+            user_story.story_guid = original_story[0].story_guid
+            user_story.story_date = original_story[0].story_date
             try:
                 user_story.save()
             except OperationError:
                 # User read the story in the original feed, too. Ugh, just ignore it.
                 pass
         else:
-            logging.info(" ***> Can't find original story: %s" % duplicate_story.id)
+            logging.info(" ***> Can't find original story: %s" % story_guid)
             user_story.delete()
+    MReadStories.merge_feeds(original_feed.pk, duplicate_feed.pk)
 
     def delete_story_feed(model, feed_field='feed_id'):
         duplicate_stories = model.objects(**{feed_field: duplicate_feed.pk})
@@ -1037,6 +1567,7 @@ def merge_feeds(original_feed_id, duplicate_feed_id, force=False):
             except (IntegrityError, OperationError):
                 logging.info("      !!!!> %s already exists" % duplicate)
                 duplicate.delete()
+            invalidate_classifiers(duplicate.user_id)
         
     delete_story_feed(MStory, 'story_feed_id')
     switch_feed(MClassifierTitle)
@@ -29,3 +29,15 @@ class NewFeeds(Task):
         for feed_pk in feed_pks:
             feed = Feed.objects.get(pk=feed_pk)
             feed.update()
+
+class RepairFeeds(Task):
+    name = 'repair-feeds'
+    max_retries = 0
+    ignore_result = True
+
+    def run(self, feed_pks, **kwargs):
+        from apps.rss_feeds.models import Feed
+        
+        for feed in Feed.objects.filter(pk__in=feed_pks):
+            feed.count_subscribers()
+            feed.schedule_feed_fetch_immediately()
@@ -2,7 +2,12 @@ from utils import json_functions as json
 from django.test.client import Client
 from django.test import TestCase
 from django.core import management
-from apps.rss_feeds.models import Feed, MStory
+import datetime
+from apps.rss_feeds.models import Feed, MStory, MFeedSchedule, MIN_SCHEDULE_MINUTES, ENTRY_NEW
+from apps.rss_feeds.models import MAX_FINGERPRINT_DISTANCE
+from utils.feed_functions import content_fingerprint, fingerprint_distance
+from utils.feed_functions import levenshtein_distance, bounded_levenshtein_distance
+from utils.feed_queue import LocalFeedQueue, FeedQueue, MFeedQueue, FEED_LEASE_MINUTES
 
 class FeedTest(TestCase):
     fixtures = ['rss_feeds.json']
@@ -104,4 +109,121 @@ class FeedTest(TestCase):
         feed = json.decode(response.content)
         
         # Test: 1 changed char in title
-        self.assertEquals(len(feed['stories']), 10)
\ No newline at end of file
+        self.assertEquals(len(feed['stories']), 10)
+    
+    def test_deferred_saves__flush_dirty_fields(self):
+        management.call_command('loaddata', 'gawker1.json', verbosity=0)
+        feed = Feed.objects.get(pk=1)
+        feed.defer_saves = True
+        
+        feed.feed_title = 'Deferred Title'
+        feed.save()
+        self.assertNotEquals(Feed.objects.get(pk=1).feed_title, 'Deferred Title')
+        self.assertEquals(feed.dirty_fields().keys(), ['feed_title'])
+        
+        self.assertEquals(feed.flush(), 1)
+        self.assertEquals(Feed.objects.get(pk=1).feed_title, 'Deferred Title')
+        self.assertEquals(feed.dirty_fields(), {})
+        self.assertEquals(feed.flush(), 0)
+    
+    def test_match_stories__shared_permalink(self):
+        feed = Feed.objects.create(feed_address='http://example.com/shared.xml',
+                                   feed_link='http://example.com/', feed_title='Shared Permalink')
+        MStory(story_feed_id=feed.pk, story_guid=u'old-story', story_title=u'Old Story',
+               story_content=u'Old content', story_permalink=u'http://example.com/',
+               story_date=datetime.datetime.utcnow() - datetime.timedelta(days=3)).save()
+        try:
+            entries = [dict(guid=u'new-story-%s' % i, title=u'New Story %s' % i, 
+                            summary=u'New content %s' % i, link=u'http://example.com/')
+                       for i in range(2)]
+            story_writes = feed.match_stories(entries, MStory.objects(story_feed_id=feed.pk))
+            self.assertEquals([entry_type for entry_type, _, _ in story_writes], 
+                              [ENTRY_NEW, ENTRY_NEW])
+        finally:
+            MStory.objects(story_feed_id=feed.pk).delete()
+    
+    def test_content_fingerprint__near_duplicates(self):
+        content = u' '.join(u'word%s' % (i % 40) for i in range(500))
+        edited = content.replace(u'word7', u'edited', 1)
+        rewritten = u' '.join(u'other%s' % (i % 17) for i in range(500))
+        
+        fingerprint = content_fingerprint(u'<p>%s</p>' % content)
+        self.assertEquals(fingerprint, content_fingerprint(content))
+        self.assertTrue(fingerprint_distance(fingerprint, content_fingerprint(edited)) <= 3)
+        self.assertTrue(fingerprint_distance(fingerprint, content_fingerprint(rewritten)) > MAX_FINGERPRINT_DISTANCE)
+    
+    def test_content_fingerprint__short_content(self):
+        summary = u'The council voted on Tuesday to approve the new budget for the coming year.'
+        
+        self.assertEquals(content_fingerprint(summary), None)
+        self.assertEquals(content_fingerprint(u' '.join([summary] * 5)), None)
+        self.assertEquals(content_fingerprint(u''), None)
+    
+    def test_bounded_levenshtein_distance(self):
+        for first, second in [(u'', u''), (u'', u'abc'), (u'kitten', u'sitting'),
+                              (u'Senate Passes Tax Bill', u'Senate Passes a Tax Bill'),
+                              (u'Apple Announces MacBook', u'City Council Approves Budget')]:
+            distance = levenshtein_distance(first, second)
+            for max_distance in range(6):
+                self.assertEquals(bounded_levenshtein_distance(first, second, max_distance),
+                                  min(distance, max_distance + 1))
+    
+    def test_feed_schedule__learns_publish_interval(self):
+        schedule = MFeedSchedule(feed_id=1)
+        now = datetime.datetime(2011, 1, 3, 12, 0)
+        self.assertEquals(schedule.next_update_minutes(now), None)
+        
+        # An hourly feed, fetched every half hour.
+        for fetch in range(20):
+            fetch_date = now + datetime.timedelta(minutes=30 * fetch)
+            story_dates = [fetch_date - datetime.timedelta(minutes=5)] if fetch % 2 else []
+            schedule.record_fetch(fetch_date, not fetch % 2, story_dates)
+        
+        self.assertEquals(set(schedule.intervals), set([60]))
+        next_update = schedule.next_update_minutes(fetch_date)
+        self.assertTrue(MIN_SCHEDULE_MINUTES < next_update < 60, next_update)
+        
+        # Gone quiet for a week, so it's checked much less often.
+        quiet_date = fetch_date + datetime.timedelta(days=7)
+        self.assertTrue(schedule.next_update_minutes(quiet_date) > 10 * next_update)
+    
+    def test_local_feed_queue__pops_due_feeds_in_order(self):
+        now = datetime.datetime(2011, 1, 3, 12, 0)
+        minutes = lambda m: now + datetime.timedelta(minutes=m)
+        queue = LocalFeedQueue()
+        queue.schedule({1: minutes(-5), 2: minutes(-30), 3: minutes(10), 4: minutes(-1)})
+        queue.schedule({4: minutes(20)})
+        
+        self.assertEquals(queue.pop_due(now, 1), [2])
+        self.assertEquals(queue.pop_due(now, 10), [1])
+        self.assertEquals(queue.pop_due(minutes(15), 10), [3])
+        
+        # Popped feeds are leased until they're rescheduled.
+        self.assertEquals(queue.pop_due(minutes(FEED_LEASE_MINUTES - 1), 10), [4])
+        self.assertEquals(sorted(queue.pop_due(minutes(FEED_LEASE_MINUTES + 20), 10)), [1, 2, 3])
+        queue.remove([1, 2, 3, 4])
+        self.assertEquals(len(queue), 0)
+    
+    def test_feed_queue__claims_each_feed_once(self):
+        MFeedQueue.objects.delete()
+        now = datetime.datetime(2011, 1, 3, 12, 0)
+        minutes = lambda m: now + datetime.timedelta(minutes=m)
+        queue = FeedQueue()
+        queue.schedule({1: minutes(-5), 2: minutes(-30), 3: minutes(10)})
+        
+        self.assertEquals(queue.pop_due(now, 10), [2, 1])
+        self.assertEquals(queue.pop_due(now, 10), [])
+        
+        # A pop that read the feeds as due after another pop leased them loses.
+        queue.schedule({3: minutes(-1)})
+        lease = minutes(FEED_LEASE_MINUTES)
+        self.assertEquals(queue.claim([1, 3], now, lease), set([3]))
+        self.assertEquals(queue.claim([1, 3], now, lease), set())
+        
+        # Filling keeps the feeds already queued, and their leases.
+        self.assertFalse(queue.is_filled())
+        queue.fill({1: minutes(-60), 4: minutes(-60)})
+        self.assertTrue(queue.is_filled())
+        self.assertEquals(len(queue), 4)
+        self.assertEquals(queue.pop_due(now, 10), [4])
+
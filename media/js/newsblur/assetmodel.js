@@ -25,6 +25,9 @@ NEWSBLUR.AssetModel.Reader = function() {
     this.starred_stories = [];
     this.starred_count = 0;
     this.read_stories_river_count = 0;
+    this.story_cursors = {};
+    this.feeds_version = null;
+    this.feed_updates_version = null;
     
     this.DEFAULT_VIEW = NEWSBLUR.Preferences.default_view || 'page';
 };
@@ -38,6 +41,7 @@ NEWSBLUR.AssetModel.Reader.prototype = {
         this.ajax['feed'] = $.manageAjax.create('feed', {queue: 'clear', abortOld: true, domCompleteTrigger: true}); 
         this.ajax['feed_page'] = $.manageAjax.create('feed_page', {queue: false, abortOld: true, abortIsNoSuccess: false, domCompleteTrigger: true}); 
         this.ajax['statistics'] = $.manageAjax.create('statistics', {queue: 'clear', abortOld: true}); 
+        this.ajax['feed_updates'] = $.manageAjax.create('feed_updates', {queue: 'clear', abortOld: true}); 
         $.ajaxSettings.traditional = true;
         return;
     },
@@ -200,6 +204,7 @@ NEWSBLUR.AssetModel.Reader.prototype = {
             });
             self.folders = subscriptions.folders;
             self.starred_count = subscriptions.starred_count;
+            self.feeds_version = null;
             callback();
         };
         
@@ -209,7 +214,9 @@ NEWSBLUR.AssetModel.Reader.prototype = {
     load_feed: function(feed_id, page, first_load, callback) {
         var self = this;
         
+        if (!page) this.story_cursors[feed_id] = null;
         var pre_callback = function(data) {
+            self.story_cursors[feed_id] = data.cursor;
             return self.load_feed_precallback(data, feed_id, callback, first_load);
         };
         
@@ -219,6 +226,7 @@ NEWSBLUR.AssetModel.Reader.prototype = {
                 {
                     feed_id: feed_id,
                     page: page,
+                    cursor: this.story_cursors[feed_id] || '',
                     feed_address: this.feeds[feed_id].feed_address
                 }, pre_callback,
                 null,
@@ -260,12 +268,15 @@ NEWSBLUR.AssetModel.Reader.prototype = {
     fetch_starred_stories: function(page, callback, first_load) {
         var self = this;
         
+        if (!page) this.story_cursors['starred'] = null;
         var pre_callback = function(data) {
+            self.story_cursors['starred'] = data.cursor;
             return self.load_feed_precallback(data, 'starred', callback, first_load);
         };
         
         this.make_request('/reader/load_starred_stories', {
-            page: page
+            page: page,
+            cursor: this.story_cursors['starred'] || ''
         }, pre_callback, null, {
             'ajax_group': (page ? 'feed_page' : 'feed')
         });
@@ -274,16 +285,20 @@ NEWSBLUR.AssetModel.Reader.prototype = {
     fetch_river_stories: function(feeds, page, callback, first_load) {
         var self = this;
         
-        if (first_load || !page) this.read_stories_river_count = 0;
+        if (first_load || !page) {
+            this.read_stories_river_count = 0;
+            this.story_cursors['river'] = null;
+        }
 
         var pre_callback = function(data) {
+            self.story_cursors['river'] = data.cursor;
             return self.load_feed_precallback(data, 'river', callback, first_load);
         };
         
         this.make_request('/reader/load_river_stories', {
             feeds: feeds,
             page: page,
-            read_stories: this.read_stories_river_count
+            cursor: this.story_cursors['river'] || ''
         }, pre_callback, null, {
             'ajax_group': (page ? 'feed_page' : 'feed')
         });
@@ -317,6 +332,7 @@ NEWSBLUR.AssetModel.Reader.prototype = {
         
         var pre_callback = function(data) {
             var updated_feeds = [];
+            self.feeds_version = data.version;
 
             for (var f in data.feeds) {
                 if (!self.feeds[f]) continue;
@@ -347,12 +363,31 @@ NEWSBLUR.AssetModel.Reader.prototype = {
         if (has_unfetched_feeds) {
             data['check_fetch_status'] = has_unfetched_feeds;
         }
+        if (this.feeds_version) {
+            data['version'] = this.feeds_version;
+        }
         
         if (NEWSBLUR.Globals.is_authenticated) {
             this.make_request('/reader/refresh_feeds', data, pre_callback);
         }
     },
     
+    wait_for_feed_updates: function(callback, error_callback) {
+        var self = this;
+        
+        var pre_callback = function(data) {
+            var updated = self.feed_updates_version && data.version != self.feed_updates_version;
+            self.feed_updates_version = data.version;
+            callback(updated);
+        };
+        
+        if (NEWSBLUR.Globals.is_authenticated) {
+            this.make_request('/reader/feed_updates', {
+                version: this.feed_updates_version || ''
+            }, pre_callback, error_callback, {'ajax_group': 'feed_updates'});
+        }
+    },
+    
     refresh_feed: function(feed_id, callback, limit) {
         var self = this;
         
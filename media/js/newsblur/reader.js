@@ -48,7 +48,8 @@
             'river_feeds_with_unreads': [],
             'mouse_position_y': parseInt(this.model.preference('lock_mouse_indicator'), 10)
         };
-        this.FEED_REFRESH_INTERVAL = (1000 * 60) * 1; // 1 minute
+        this.FEED_REFRESH_INTERVAL = (1000 * 60) * 10; // 10 minutes, as a fallback to feed updates
+        this.FEED_UPDATES_DELAY = 25; // seconds between short feed update waits
         
         // ==================
         // = Event Handlers =
@@ -3650,6 +3651,28 @@
             }, this.FEED_REFRESH_INTERVAL);
         },
         
+        setup_feed_updates: function() {
+            var self = this;
+            
+            this.model.wait_for_feed_updates(function(updated) {
+                if (updated && !self.flags['pause_feed_refreshing']) {
+                    self.model.refresh_feeds(_.bind(function(updated_feeds) {
+                        self.post_feed_refresh(updated_feeds);
+                    }, self), self.flags['has_unfetched_feeds']);
+                    self.setup_feed_updates();
+                } else if (!self.model.feed_updates_version) {
+                    // No version means the server has no cache to wait on, so it
+                    // answered at once. Back off instead of polling in a loop.
+                    _.delay(_.bind(self.setup_feed_updates, self), 1000 * 60);
+                } else {
+                    _.delay(_.bind(self.setup_feed_updates, self), 1000 * self.FEED_UPDATES_DELAY);
+                }
+            }, function() {
+                // Server unreachable, so wait before reconnecting. The refresh timer keeps running.
+                _.delay(_.bind(self.setup_feed_updates, self), 1000 * 60);
+            });
+        },
+        
         force_feeds_refresh: function(callback, update_all) {
             if (callback) {
                 this.cache.refresh_callback = callback;
@@ -4117,6 +4140,7 @@
             this.flags['count_unreads_after_import_finished'] = true;
             this.$s.$feed_link_loader.fadeOut(250);
             this.setup_feed_refresh();
+            this.setup_feed_updates();
             if (!this.flags['has_unfetched_feeds']) {
                 this.hide_progress_bar();
             }
@@ -194,6 +194,9 @@ SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
 TEST_RUNNER = "utils.testrunner.TestRunner"
 DAYS_OF_UNREAD = 14
 SUBSCRIBER_EXPIRE = 12
+# Where feeds wait for their next fetch: 'mongo', shared by every process,
+# or 'local', a heap in this process.
+FEED_QUEUE_BACKEND = 'mongo'
 SESSION_COOKIE_NAME = 'newsblur_sessionid'
 SESSION_COOKIE_AGE = 60*60*24*365*2 # 2 years
 
@@ -284,7 +287,7 @@ BROKER_VHOST = "newsblurvhost"
 CELERY_RESULT_BACKEND = "amqp"
 
 CELERYD_LOG_LEVEL = 'ERROR'
-CELERY_IMPORTS = ("apps.rss_feeds.tasks", )
+CELERY_IMPORTS = ("apps.rss_feeds.tasks", "apps.reader.tasks", )
 CELERYD_CONCURRENCY = 4
 CELERY_IGNORE_RESULT = True
 CELERYD_MAX_TASKS_PER_CHILD = 10
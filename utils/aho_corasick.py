@@ -0,0 +1,48 @@
+from collections import deque
+
+class PhraseMatcher(object):
+    """
+    Aho-Corasick automaton over a list of phrases. `search(text)` finds every
+    phrase that occurs in the text in one pass over it, however many phrases
+    there are. Plain lists and dicts, so it pickles into the cache.
+    """
+
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for index, phrase in enumerate(phrases):
+            node = 0
+            for char in phrase:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append(index)
+
+        # Breadth first, so a node's fail link is always built before its children's.
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text):
+        """Returns the set of indexes of the phrases found in `text`."""
+        matches = set(self.output[0])
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            if self.output[node]:
+                matches.update(self.output[node])
+        return matches
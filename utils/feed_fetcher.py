@@ -4,18 +4,28 @@ from django.core.cache import cache
 from django.conf import settings
 from django.db import IntegrityError
 # from mongoengine.queryset import Q
-from apps.reader.models import UserSubscription, MUserStory
+from apps.reader.models import UserSubscription, MUserStory, publish_feed_updates
 from apps.rss_feeds.models import Feed, MStory
 from apps.rss_feeds.importer import PageImporter
 from utils import feedparser
+from utils import http_pool
 from utils.story_functions import pre_process_story
 from utils import log as logging
-from utils.feed_functions import timelimit, TimeoutError
+from utils.feed_functions import timelimit, TimeoutError, check_deadline
+from utils import json_functions as json
+import sys
 import time
 import datetime
 import traceback
+import threading
 import multiprocessing
+import Queue
+import pickle
+import base64
+import calendar
+import urllib
 import urllib2
+from email.Utils import formatdate
 import xml.sax
 
 # Refresh feed code adapted from Feedjack.
@@ -27,6 +37,8 @@ USER_AGENT = 'NewsBlur Fetcher %s - %s' % (VERSION, URL)
 SLOWFEED_WARNING = 10
 ENTRY_NEW, ENTRY_UPDATED, ENTRY_SAME, ENTRY_ERR = range(4)
 FEED_OK, FEED_SAME, FEED_ERRPARSE, FEED_ERRHTTP, FEED_ERREXC = range(5)
+# Seconds run_jobs waits for worker stats before checking its workers are alive.
+WORKER_STATS_TIMEOUT = 10
 
 
 def mtime(ttime):
@@ -35,37 +47,154 @@ def mtime(ttime):
     return datetime.datetime.fromtimestamp(time.mktime(ttime))
     
     
+class FeedResponse:
+    """
+    A downloaded but not yet parsed feed. Only carries plain data, so it can
+    be handed to a parser in another process, and quacks enough like a
+    urllib2 response for feedparser.parse() to treat it as the original.
+    """
+    def __init__(self, f=None, data=None, error=None):
+        self.data = data
+        self.error = error
+        if hasattr(f, 'headers'):
+            self.headers = FeedResponseHeaders(f.headers.dict)
+        if hasattr(f, 'url'):
+            self.url = f.url
+        if hasattr(f, 'status'):
+            self.status = f.status
+
+    def read(self):
+        if self.error:
+            raise self.error
+        return self.data
+
+    def info(self):
+        return getattr(self, 'headers', FeedResponseHeaders())
+
+    def close(self):
+        pass
+
+
+class FeedResponseHeaders(dict):
+    @property
+    def dict(self):
+        return self
+
+    def getheader(self, name, default=None):
+        return self.get(name.lower(), default)
+
+
+class FeedURLHandler(urllib2.HTTPRedirectHandler, urllib2.HTTPDefaultErrorHandler):
+    """
+    Returns HTTP errors and 304s as responses instead of raising them, and
+    keeps the status of the first redirect, as feedparser's own handler
+    does. ProcessFeed acts on those statuses.
+    """
+    def http_error_default(self, req, fp, code, msg, headers):
+        response = urllib.addinfourl(fp, headers, req.get_full_url())
+        response.status = code
+        return response
+    
+    def http_error_302(self, req, fp, code, msg, headers):
+        if 'location' not in headers.dict:
+            return self.http_error_default(req, fp, code, msg, headers)
+        response = urllib2.HTTPRedirectHandler.http_error_302(self, req, fp, code, msg, headers)
+        if not hasattr(response, 'status'):
+            response.status = code
+        return response
+    
+    http_error_301 = http_error_300 = http_error_303 = http_error_307 = http_error_302
+
+
+def feed_request(url, etag=None, modified=None):
+    """
+    A conditional GET for the feed at `url`, with the headers feedparser
+    sends. `modified` is a UTC datetime. Credentials in the url are sent as
+    basic auth.
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    auth = None
+    scheme, rest = urllib.splittype(url)
+    host, rest = urllib.splithost(rest)
+    if host:
+        credentials, host = urllib.splituser(host)
+        if credentials:
+            url = '%s://%s%s' % (scheme, host, rest)
+            auth = base64.encodestring(urllib.unquote(credentials)).strip()
+    
+    request = urllib2.Request(url)
+    request.add_header('User-Agent', USER_AGENT)
+    request.add_header('Accept', feedparser.ACCEPT_HEADER)
+    request.add_header('Accept-encoding', 'gzip, deflate')
+    request.add_header('A-IM', 'feed')
+    if etag:
+        request.add_header('If-None-Match', etag)
+    if modified:
+        request.add_header('If-Modified-Since', 
+                           formatdate(calendar.timegm(modified.utctimetuple()), usegmt=True))
+    if auth:
+        request.add_header('Authorization', 'Basic %s' % auth)
+    return request
+
+
 class FetchFeed:
-    def __init__(self, feed_id, options):
-        self.feed = Feed.objects.get(pk=feed_id)
+    def __init__(self, feed_id, options, feed=None):
+        self.feed = feed or Feed.objects.get(pk=feed_id)
         self.options = options
         self.fpf = None
     
-    @timelimit(30)
     def fetch(self):
         """ 
         Uses feedparser to download the feed. Will be parsed later.
         """
+        response = self.download()
+        self.fpf = self.parse(response)
+        
+        return FEED_OK, self.fpf
+    
+    @timelimit(30)
+    def download(self):
+        """
+        Conditional GET of the feed, without parsing it. Failures are carried
+        on the response, the same way feedparser reports them as bozo.
+        """
         identity = self.get_identity()
         log_msg = u'%2s ---> [%-30s] Fetching feed (%d)' % (identity,
                                                             unicode(self.feed)[:30],
                                                             self.feed.id)
         logging.debug(log_msg)
-                                                 
-        self.feed.set_next_scheduled_update()
-        etag=self.feed.etag
-        modified = self.feed.last_modified.utctimetuple()[:7] if self.feed.last_modified else None
+        
+        etag = self.feed.etag
+        modified = self.feed.last_modified
         
         if self.options.get('force') or not self.feed.fetched_once:
             modified = None
             etag = None
-            
-        self.fpf = feedparser.parse(self.feed.feed_address,
-                                    agent=USER_AGENT,
-                                    etag=etag,
-                                    modified=modified)
         
-        return FEED_OK, self.fpf
+        try:
+            request = feed_request(self.feed.feed_address, etag, modified)
+            opener = urllib2.build_opener(*(http_pool.handlers() + [FeedURLHandler()]))
+            f = opener.open(request)
+            data = f.read()
+        except TimeoutError:
+            raise
+        except Exception, e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = Exception(repr(e))
+            return FeedResponse(error=e)
+        
+        response = FeedResponse(f, data)
+        if hasattr(f, 'close'):
+            f.close()
+        
+        return response
+    
+    @staticmethod
+    def parse(response):
+        return feedparser.parse(response, agent=USER_AGENT)
         
     def get_identity(self):
         identity = "X"
@@ -77,10 +206,11 @@ class FetchFeed:
         return identity
         
 class ProcessFeed:
-    def __init__(self, feed_id, fpf, options):
+    def __init__(self, feed_id, fpf, options, feed=None):
         self.feed_id = feed_id
         self.options = options
         self.fpf = fpf
+        self.preloaded_feed = feed
         self.entry_trans = {
             ENTRY_NEW:'new',
             ENTRY_UPDATED:'updated',
@@ -89,18 +219,37 @@ class ProcessFeed:
         self.entry_keys = sorted(self.entry_trans.keys())
     
     def refresh_feed(self):
-        self.feed = Feed.objects.get(pk=self.feed_id) 
+        self.feed = self.preloaded_feed or Feed.objects.get(pk=self.feed_id)
         
     def process(self, first_run=True):
         """ Downloads and parses a feed.
         """
-        self.refresh_feed()
+        ret_feed, story_writes = self.match(first_run)
+        if ret_feed != FEED_OK:
+            return ret_feed, self.empty_entries()
+        
+        ret_values = self.feed.write_stories(story_writes)
+        self.log_entries(ret_values)
+        self.finish()
         
-        ret_values = {
+        return FEED_OK, ret_values
+    
+    def empty_entries(self):
+        return {
             ENTRY_NEW:0,
             ENTRY_UPDATED:0,
             ENTRY_SAME:0,
             ENTRY_ERR:0}
+    
+    def match(self, first_run=True):
+        """
+        Handles the HTTP status of the fetched feed, then matches its entries
+        against stored stories. Nothing is written to the stories collection;
+        returns the story writes for `Feed.write_stories`.
+        """
+        self.refresh_feed()
+        
+        ret_values = []
 
         # logging.debug(u' ---> [%d] Processing %s' % (self.feed.id, self.feed.feed_title))
         
@@ -210,27 +359,116 @@ class ProcessFeed:
             story_feed_id=self.feed.pk
         ).limit(len(story_guids))
         
-        logging.info(u'   ---> [%-30s] Parsing: %s existing stories' % (
+        logging.info(u'   ---> [%-30s] Parsing: %s stories' % (
                       unicode(self.feed)[:30],
-                      len(existing_stories))) 
+                      len(story_guids)))
         # MStory.objects(
         #     (Q(story_date__gte=start_date) & Q(story_date__lte=end_date))
         #     | (Q(story_guid__in=story_guids)),
         #     story_feed=self.feed
         # ).order_by('-story_date')
-        ret_values = self.feed.add_update_stories(self.fpf.entries, existing_stories)
+        story_writes = self.feed.match_stories(self.fpf.entries, existing_stories)
         
+        return FEED_OK, story_writes
+    
+    def log_entries(self, ret_values):
         logging.debug(u'   ---> [%-30s] Parsed Feed: %s' % (
                       unicode(self.feed)[:30], 
                       u' '.join(u'%s=%d' % (self.entry_trans[key],
                               ret_values[key]) for key in self.entry_keys),))
+    
+    def finish(self):
         self.feed.update_all_statistics()
         self.feed.trim_feed()
         self.feed.save_feed_history(200, "OK")
-        
-        return FEED_OK, ret_values
 
-        
+
+class FetchPool:
+    """
+    Keeps up to `concurrency` feed downloads in flight for a single worker.
+
+    Fetcher threads only talk to the network (no database access), and hand
+    each finished download back to the worker in completion order, so one
+    slow site no longer holds up every feed queued behind it. Processing the
+    downloaded feeds stays on the worker's own thread.
+    
+    With `download_only`, feeds are not parsed either, and each fetch result
+    carries the unparsed FeedResponse instead. Feeds already loaded by the
+    worker can be passed in `feeds`, keyed by id.
+    """
+    def __init__(self, options, concurrency, download_only=False, feeds=None):
+        self.options = options
+        self.concurrency = concurrency
+        self.download_only = download_only
+        self.feeds = feeds if feeds is not None else {}
+        self.fetch_queue = Queue.Queue()
+        self.done_queue = Queue.Queue()
+        self.threads = []
+
+    def fetch(self, feed_ids):
+        """
+        Yields (feed_id, fetch_result, fetch_error, fetch_start) as downloads
+        complete, where fetch_result is what FetchFeed.fetch() returned and
+        fetch_error is the sys.exc_info() of anything it raised.
+        """
+        self.start()
+        feed_ids = iter(feed_ids)
+        pending = 0
+
+        try:
+            for feed_id in feed_ids:
+                self.queue_fetch(feed_id)
+                pending += 1
+                if pending >= self.concurrency:
+                    break
+
+            while pending:
+                fetched_feed = self.done_queue.get()
+                pending -= 1
+                for next_feed_id in feed_ids:
+                    self.queue_fetch(next_feed_id)
+                    pending += 1
+                    break
+                yield fetched_feed
+        finally:
+            self.stop()
+
+    def queue_fetch(self, feed_id):
+        try:
+            ffeed = FetchFeed(feed_id, self.options, feed=self.feeds.get(feed_id))
+        except Exception:
+            self.done_queue.put((feed_id, None, sys.exc_info(), datetime.datetime.utcnow()))
+        else:
+            self.fetch_queue.put(ffeed)
+
+    def start(self):
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self.fetcher)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for _ in self.threads:
+            self.fetch_queue.put(None)
+        self.threads = []
+
+    def fetcher(self):
+        while True:
+            ffeed = self.fetch_queue.get()
+            if ffeed is None:
+                break
+            fetch_start = datetime.datetime.utcnow()
+            try:
+                if self.download_only:
+                    fetch_result = FEED_OK, ffeed.download()
+                else:
+                    fetch_result = ffeed.fetch()
+                self.done_queue.put((ffeed.feed.pk, fetch_result, None, fetch_start))
+            except Exception:
+                self.done_queue.put((ffeed.feed.pk, None, sys.exc_info(), fetch_start))
+
+
 class Dispatcher:
     def __init__(self, options, num_threads):
         self.options = options
@@ -255,51 +493,100 @@ class Dispatcher:
         self.num_threads = num_threads
         self.time_start = datetime.datetime.utcnow()
         self.workers = []
+        self.feeds = {}
 
     def refresh_feed(self, feed_id):
         """Update feed, since it may have changed"""
+        if feed_id in self.feeds:
+            return self.feeds[feed_id]
         return Feed.objects.get(pk=feed_id)
+    
+    def load_feeds(self, feed_ids):
+        """
+        Loads a batch of feeds in one query and holds on to them while they are
+        processed. Their saves are deferred until finish_feed flushes each
+        one's changed fields in a single UPDATE.
+        """
+        feeds = Feed.objects.in_bulk(feed_ids)
+        for feed in feeds.values():
+            feed.defer_saves = True
+        self.feeds.update(feeds)
+    
+    def queued_feeds(self, feed_queue):
+        for feed_ids in iter(feed_queue.get, None):
+            if self.options.get('batch_size'):
+                self.load_feeds(feed_ids)
+            for feed_id in feed_ids:
+                yield feed_id
         
-    def process_feed_wrapper(self, feed_queue):
-        delta = None
+    def process_feed_wrapper(self, feed_queue, worker_stats):
+        """
+        Pulls lists of feed ids off the shared `feed_queue` until it hits a
+        None, so every worker keeps busy until the whole batch has drained. Reports
+        (identity, feeds processed, seconds busy) on `worker_stats`, even if
+        the worker dies, so run_jobs isn't left waiting on it.
+        """
         current_process = multiprocessing.current_process()
         identity = "X"
         if current_process._identity:
             identity = current_process._identity[0]
-            
-        for feed_id in feed_queue:
+        worker_start = time.time()
+        self.feeds_processed = 0
+        self.idle_seconds = 0.0
+        try:
+            self.process_feeds(feed_queue, identity)
+        finally:
+            http_pool.pool.log_stats()
+            busy_seconds = time.time() - worker_start - self.idle_seconds
+            worker_stats.put((identity, self.feeds_processed, busy_seconds))
+    
+    def timed_jobs(self, jobs):
+        """Passes `jobs` through, adding the time spent waiting for each to idle_seconds."""
+        jobs = iter(jobs)
+        while True:
+            wait_start = time.time()
+            job = jobs.next()
+            self.idle_seconds += time.time() - wait_start
+            yield job
+    
+    def process_feeds(self, feed_queue, identity):
+        queued_feeds = self.queued_feeds(feed_queue)
+
+        fetch_concurrency = self.options.get('fetch_concurrency', 0)
+        if fetch_concurrency > 1:
+            fetch_pool = FetchPool(self.options, fetch_concurrency, feeds=self.feeds)
+            fetched_feeds = fetch_pool.fetch(queued_feeds)
+        else:
+            fetched_feeds = ((feed_id, None, None, None) for feed_id in queued_feeds)
+
+        for feed_id, fetch_result, fetch_error, fetch_start in self.timed_jobs(fetched_feeds):
+            self.feeds_processed += 1
             ret_entries = {
                 ENTRY_NEW: 0,
                 ENTRY_UPDATED: 0,
                 ENTRY_SAME: 0,
                 ENTRY_ERR: 0
             }
-            start_time = datetime.datetime.utcnow()
+            start_time = fetch_start or datetime.datetime.utcnow()
+            new_stories = None
 
             try:
                 feed = self.refresh_feed(feed_id)
-                
-                ffeed = FetchFeed(feed_id, self.options)
-                ret_feed, fetched_feed = ffeed.fetch()
+
+                if fetch_error:
+                    raise fetch_error[0], fetch_error[1], fetch_error[2]
+                if not fetch_result:
+                    ffeed = FetchFeed(feed_id, self.options, feed=self.feeds.get(feed_id))
+                    fetch_result = ffeed.fetch()
+                ret_feed, fetched_feed = fetch_result
                 
                 if ((fetched_feed and ret_feed == FEED_OK) or self.options['force']):
-                    pfeed = ProcessFeed(feed_id, fetched_feed, self.options)
+                    pfeed = ProcessFeed(feed_id, fetched_feed, self.options,
+                                        feed=self.feeds.get(feed_id))
                     ret_feed, ret_entries = pfeed.process()
+                    new_stories = getattr(pfeed.feed, 'new_stories', None)
                     
-                    feed = self.refresh_feed(feed_id)
-                    
-                    if ret_entries.get(ENTRY_NEW) or self.options['force'] or not feed.fetched_once:
-                        if not feed.fetched_once:
-                            feed.fetched_once = True
-                            feed.save()
-                        MUserStory.delete_old_stories(feed_id=feed.pk)
-                        try:
-                            self.count_unreads_for_subscribers(feed)
-                        except TimeoutError:
-                            logging.debug('   ---> [%-30s] Unread count took too long...' % (unicode(feed)[:30],))
-                    cache.delete('feed_stories:%s-%s-%s' % (feed.id, 0, 25))
-                    # if ret_entries.get(ENTRY_NEW) or ret_entries.get(ENTRY_UPDATED) or self.options['force']:
-                    #     feed.get_stories(force=True)
+                    self.update_subscribers(feed_id, ret_entries, new_stories)
             except KeyboardInterrupt:
                 break
             except urllib2.HTTPError, e:
@@ -310,7 +597,7 @@ class Dispatcher:
                 continue
             except TimeoutError, e:
                 logging.debug('   ---> [%-30s] Feed fetch timed out...' % (unicode(feed)[:30]))
-                feed.save_feed_history(505, e.msg, e.fp.read())
+                feed.save_feed_history(505, 'Timeout', '')
                 fetched_feed = None
             except Exception, e:
                 logging.debug('[%d] ! -------------------------' % (feed_id,))
@@ -321,80 +608,189 @@ class Dispatcher:
                 feed.save_feed_history(500, "Error", tb)
                 fetched_feed = None
             
-            feed = self.refresh_feed(feed_id)
-            if ((self.options['force']) or 
-                (fetched_feed and
-                 feed.feed_link and
-                 (ret_feed == FEED_OK or
-                  (ret_feed == FEED_SAME and feed.stories_last_month > 10)))):
-                  
-                logging.debug(u'   ---> [%-30s] Fetching page' % (unicode(feed)[:30]))
-                page_importer = PageImporter(feed.feed_link, feed)
-                page_importer.fetch_page()
-
-            feed = self.refresh_feed(feed_id)
-            delta = datetime.datetime.utcnow() - start_time
-            
-            feed.last_load_time = max(1, delta.seconds)
-            feed.fetched_once = True
+            self.fetch_page(feed_id, ret_feed, fetched_feed)
+            self.finish_feed(feed_id, ret_feed, ret_entries, start_time, identity, new_stories)
+    
+    def update_subscribers(self, feed_id, ret_entries, new_stories=None):
+        feed = self.refresh_feed(feed_id)
+        
+        if ret_entries.get(ENTRY_NEW) or self.options['force'] or not feed.fetched_once:
+            # Only brand new stories can be counted in place. Updated stories
+            # may have moved between scores, so those need a recalculation.
+            needs_recalc = (ret_entries.get(ENTRY_UPDATED) or self.options['force'] or 
+                            not feed.fetched_once or new_stories is None)
+            if not feed.fetched_once:
+                feed.fetched_once = True
+                feed.save()
+            MUserStory.delete_old_stories(feed_id=feed.pk)
             try:
+                self.count_unreads_for_subscribers(feed, new_stories or [], needs_recalc)
+            except TimeoutError:
+                logging.debug('   ---> [%-30s] Unread count took too long...' % (unicode(feed)[:30],))
+                # Some counts may not have been moved, so recount them all.
+                UserSubscription.objects.filter(feed=feed, active=True).update(needs_unread_recalc=True)
+                # Recount active readers' now, so their clients hear about the new
+                # stories. The task publishes when it's done.
+                UNREAD_CUTOFF = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
+                UserSubscription.queue_recalc(UserSubscription.objects.filter(
+                    feed=feed, active=True, needs_unread_recalc=True,
+                    user__profile__last_seen_on__gte=UNREAD_CUTOFF))
+        if self.options['force']:
+            feed.expire_stories_cache(added=True, updated=True)
+        # if ret_entries.get(ENTRY_NEW) or ret_entries.get(ENTRY_UPDATED) or self.options['force']:
+        #     feed.get_stories(force=True)
+    
+    def fetch_page(self, feed_id, ret_feed, fetched_feed):
+        feed = self.refresh_feed(feed_id)
+        if ((self.options['force']) or 
+            (fetched_feed and
+             feed.feed_link and
+             (ret_feed == FEED_OK or
+              (ret_feed == FEED_SAME and feed.stories_last_month > 10)))):
+              
+            logging.debug(u'   ---> [%-30s] Fetching page' % (unicode(feed)[:30]))
+            page_importer = PageImporter(feed.feed_link, feed)
+            page_importer.fetch_page()
+    
+    def finish_feed(self, feed_id, ret_feed, ret_entries, start_time, identity, new_stories=None):
+        feed = self.refresh_feed(feed_id)
+        delta = datetime.datetime.utcnow() - start_time
+        
+        feed.last_load_time = max(1, delta.seconds)
+        feed.fetched_once = True
+        if ret_feed in (FEED_OK, FEED_SAME):
+            feed.record_fetch(not_modified=(ret_feed == FEED_SAME), new_stories=new_stories)
+        else:
+            # Failed fetches teach the schedule nothing, but still need their
+            # next fetch scheduled, or they'd come back at every lease expiry.
+            feed.set_next_scheduled_update(save=False)
+        try:
+            if self.feeds.pop(feed_id, None):
+                feed.flush()
+            else:
                 feed.save()
-            except IntegrityError:
-                logging.debug("   ---> [%-30s] IntegrityError on feed: %s" % (unicode(feed)[:30], feed.feed_address,))
-            
-            done_msg = (u'%2s ---> [%-30s] Processed in %s [%s]' % (
-                identity, feed.feed_title[:30], unicode(delta),
-                self.feed_trans[ret_feed],))
-            logging.debug(done_msg)
-            
-            self.feed_stats[ret_feed] += 1
-            for key, val in ret_entries.items():
-                self.entry_stats[key] += val
+        except IntegrityError:
+            logging.debug("   ---> [%-30s] IntegrityError on feed: %s" % (unicode(feed)[:30], feed.feed_address,))
         
-        time_taken = datetime.datetime.utcnow() - self.time_start
-        history = FeedUpdateHistory(
-            number_of_feeds=len(feed_queue),
-            seconds_taken=time_taken.seconds
-        )
-        history.save()
+        done_msg = (u'%2s ---> [%-30s] Processed in %s [%s]' % (
+            identity, feed.feed_title[:30], unicode(delta),
+            self.feed_trans[ret_feed],))
+        logging.debug(done_msg)
+        
+        self.feed_stats[ret_feed] += 1
+        for key, val in ret_entries.items():
+            self.entry_stats[key] += val
     
     @timelimit(20)
-    def count_unreads_for_subscribers(self, feed):
+    def count_unreads_for_subscribers(self, feed, new_stories, needs_recalc=False):
+        """
+        Adds the feed's new stories to each subscriber's unread counts. When
+        the counts can't be moved in place (`needs_recalc`), subscribers are
+        flagged instead, and recalculated here only with compute_scores.
+        """
         UNREAD_CUTOFF = datetime.datetime.utcnow() - datetime.timedelta(days=settings.DAYS_OF_UNREAD)
-        user_subs = UserSubscription.objects.filter(feed=feed, 
-                                                    active=True,
-                                                    user__profile__last_seen_on__gte=UNREAD_CUTOFF)\
-                                            .order_by('-last_read_date')
+        user_subs = list(UserSubscription.objects.select_related('feed')
+                                                 .filter(feed=feed, 
+                                                         active=True,
+                                                         user__profile__last_seen_on__gte=UNREAD_CUTOFF)
+                                                 .order_by('-last_read_date'))
         logging.debug(u'   ---> [%-30s] Computing scores for all feed subscribers: %s subscribers' % (
-                      unicode(feed)[:30], user_subs.count()))
+                      unicode(feed)[:30], len(user_subs)))
         
-        stories_db = MStory.objects(story_feed_id=feed.pk,
-                                    story_date__gte=UNREAD_CUTOFF)
-        for sub in user_subs:
-            cache.delete('usersub:%s' % sub.user_id)
-            sub.needs_unread_recalc = True
-            sub.save()
+        if needs_recalc:
+            dirty_subs = [sub.pk for sub in user_subs if not sub.needs_unread_recalc]
+            UserSubscription.objects.filter(pk__in=dirty_subs).update(needs_unread_recalc=True)
+            for sub in user_subs:
+                cache.delete('usersub:%s' % sub.user_id)
+                sub.needs_unread_recalc = True
+        else:
+            UserSubscription.bulk_update_unread_counts(feed, user_subs, new_stories, 1)
             
         if self.options['compute_scores']:
+            stories_db = MStory.objects(story_feed_id=feed.pk,
+                                        story_date__gte=UNREAD_CUTOFF)
             for sub in user_subs:
+                if not sub.needs_unread_recalc:
+                    continue
+                # Every sub left is still flagged for recalc, so stopping here is safe.
+                check_deadline()
                 silent = False if self.options['verbose'] >= 2 else True
                 sub.calculate_feed_scores(silent=silent, stories_db=stories_db)
+        elif needs_recalc:
+            # Clients now wait to be told about new stories rather than 
+            # polling, so recount now. The task publishes when it's done.
+            UserSubscription.queue_recalc(user_subs)
+            return
+        
+        publish_feed_updates([sub.user_id for sub in user_subs])
             
-    def add_jobs(self, feeds_queue, feeds_count=1):
-        """ adds a feed processing job to the pool
+    def add_jobs(self, feed_ids):
+        """ adds feeds to process to the pool
         """
-        self.feeds_queue = feeds_queue
-        self.feeds_count = feeds_count
+        self.feed_ids = feed_ids
+        self.feeds_count = len(feed_ids)
             
     def run_jobs(self):
+        if self.options.get('pipeline'):
+            from utils.feed_pipeline import FeedPipeline
+            FeedPipeline(self.options, self.num_threads).run(self.feed_ids)
+            return
+        
+        num_workers = 1 if self.options['single_threaded'] else self.num_threads
+        run_start = time.time()
+        feed_queue = multiprocessing.Queue()
+        worker_stats = multiprocessing.Queue()
+        batch_size = max(1, self.options.get('batch_size') or 1)
+        for i in range(0, len(self.feed_ids), batch_size):
+            feed_queue.put(self.feed_ids[i:i+batch_size])
+        for _ in range(num_workers):
+            feed_queue.put(None)
+        
         if self.options['single_threaded']:
-            self.process_feed_wrapper(self.feeds_queue[0])
+            self.process_feed_wrapper(feed_queue, worker_stats)
         else:
-            for i in range(self.num_threads):
-                feed_queue = self.feeds_queue[i]
+            for i in range(num_workers):
                 self.workers.append(multiprocessing.Process(target=self.process_feed_wrapper,
-                                                            args=(feed_queue,)))
-            for i in range(self.num_threads):
-                self.workers[i].start()
+                                                            args=(feed_queue, worker_stats)))
+            for worker in self.workers:
+                worker.start()
+        
+        # Collect every worker's stats before joining, so no worker blocks on a full pipe.
+        # A worker killed outright never reports, so stop waiting once none are left.
+        stats = []
+        while len(stats) < num_workers:
+            try:
+                stats.append(worker_stats.get(timeout=WORKER_STATS_TIMEOUT))
+            except Queue.Empty:
+                if not any(worker.is_alive() for worker in self.workers):
+                    logging.debug(u' ---> %s of %s workers died without reporting' % (
+                                  num_workers - len(stats), num_workers))
+                    break
+        for worker in self.workers:
+            worker.join()
+        
+        self.save_update_history(run_start, stats)
+    
+    def save_update_history(self, run_start, stats):
+        seconds_taken = time.time() - run_start
+        utilisation = []
+        # Seconds are time spent inside jobs, not waiting on the queue for them.
+        for identity, feeds_processed, seconds in sorted(stats):
+            utilisation.append({
+                'worker': identity,
+                'feeds': feeds_processed,
+                'seconds': int(seconds),
+                'utilisation': round(seconds / max(1.0, seconds_taken), 2),
+            })
+            logging.debug(u' ---> Worker %s: %s feeds, busy %ss (%d%% of run)' % (
+                          identity, feeds_processed, int(seconds),
+                          utilisation[-1]['utilisation'] * 100))
+        
+        history = FeedUpdateHistory(
+            number_of_feeds=self.feeds_count,
+            seconds_taken=int(seconds_taken),
+            worker_utilisation=json.encode(utilisation)
+        )
+        history.save()
 
                 
\ No newline at end of file
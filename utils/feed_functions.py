@@ -1,38 +1,189 @@
 import datetime
+import hashlib
+import re
 import threading
+import signal
+import time
 import sys
+from collections import defaultdict
+from contextlib import contextmanager
 from django.utils.translation import ungettext
 from utils import feedfinder
 
 class TimeoutError(Exception): pass
+
+# Shorter texts aren't fingerprinted. See content_fingerprint.
+MIN_FINGERPRINT_WORDS = 100
+
+_deadlines = threading.local()
+
 def timelimit(timeout):
-    """borrowed from web.py"""
+    """
+    Gives the decorated call `timeout` seconds, then raises TimeoutError in
+    the calling thread itself, so nothing is left running in the background.
+    
+    In a process's main thread, SIGALRM interrupts the call wherever it is,
+    blocking socket reads included. Other threads, like web requests, can't
+    be signalled, so there the call runs on a helper thread that is given up
+    on at the deadline. It runs under the same deadline, so pooled 
+    connections (utils.http_pool) and check_deadline() still end it soon after.
+    
+    Time spent in pause_deadline() doesn't count, on any thread.
+    """
     def _1(function):
         def _2(*args, **kw):
-            class Dispatch(threading.Thread):
-                def __init__(self):
-                    threading.Thread.__init__(self)
-                    self.result = None
-                    self.error = None
-                    
-                    self.setDaemon(True)
-                    self.start()
-
-                def run(self):
-                    try:
-                        self.result = function(*args, **kw)
-                    except:
-                        self.error = sys.exc_info()
-
-            c = Dispatch()
-            c.join(timeout)
-            if c.isAlive():
-                raise TimeoutError, 'took too long'
-            if c.error:
-                raise c.error[0], c.error[1]
-            return c.result
+            if not _can_alarm():
+                return _call_in_thread(function, args, kw, timeout)
+            with deadline(timeout):
+                return function(*args, **kw)
+        _2.__name__ = function.__name__
+        _2.__doc__ = function.__doc__
         return _2
     return _1
+
+@contextmanager
+def deadline(timeout):
+    stack = getattr(_deadlines, 'stack', None)
+    if stack is None:
+        stack = _deadlines.stack = []
+    started = time.time()
+    expires = started + timeout
+    if stack:
+        expires = min(expires, stack[-1])
+    stack.append(expires)
+    clock = _pause_clock()
+    paused_before = clock.paused()
+    
+    use_alarm = _can_alarm()
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        previous_timer = signal.setitimer(signal.ITIMER_REAL, max(expires - started, 0.001))[0]
+    try:
+        yield expires
+    finally:
+        stack.pop()
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+            if previous_timer:
+                elapsed = time.time() - started - (clock.paused() - paused_before)
+                signal.setitimer(signal.ITIMER_REAL, max(previous_timer - elapsed, 0.001))
+
+@contextmanager
+def pause_deadline():
+    """
+    Stops the current thread's deadlines while the block runs. For waits on
+    our own limits, like a host's connection slots, which shouldn't make a
+    call look slow.
+    """
+    stack = getattr(_deadlines, 'stack', None)
+    clock = _pause_clock()
+    if not stack or clock.since is not None:
+        yield
+        return
+    
+    remaining_timer = _can_alarm() and signal.setitimer(signal.ITIMER_REAL, 0)[0]
+    started = time.time()
+    clock.start()
+    try:
+        yield
+    finally:
+        clock.stop()
+        paused = time.time() - started
+        stack[:] = [expires + paused for expires in stack]
+        if remaining_timer:
+            signal.setitimer(signal.ITIMER_REAL, remaining_timer)
+
+class _PauseClock(object):
+    """
+    Seconds a thread's deadlines have been paused. A helper thread's clock
+    also runs its caller's, which is waiting on it under the same deadline.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.total = 0.0
+        self.since = None
+    
+    def start(self):
+        self.since = time.time()
+        if self.parent:
+            self.parent.start()
+    
+    def stop(self):
+        if self.since is not None:
+            self.total += time.time() - self.since
+            self.since = None
+        if self.parent:
+            self.parent.stop()
+    
+    def paused(self):
+        if self.since is None:
+            return self.total
+        return self.total + time.time() - self.since
+
+def _pause_clock():
+    clock = getattr(_deadlines, 'clock', None)
+    if clock is None:
+        clock = _deadlines.clock = _PauseClock()
+    return clock
+
+def _can_alarm():
+    return (hasattr(signal, 'setitimer') and 
+            threading.currentThread().getName() == 'MainThread')
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError, 'took too long'
+
+def _call_in_thread(function, args, kw, timeout):
+    remaining = deadline_remaining()
+    if remaining is not None:
+        timeout = min(timeout, remaining)
+    clock = _pause_clock()
+    paused_before = clock.paused()
+    expires = time.time() + timeout
+    
+    class Dispatch(threading.Thread):
+        def __init__(self):
+            threading.Thread.__init__(self)
+            self.result = None
+            self.error = None
+            
+            self.setDaemon(True)
+            self.start()
+        
+        def run(self):
+            _deadlines.clock = _PauseClock(parent=clock)
+            try:
+                with deadline(timeout):
+                    self.result = function(*args, **kw)
+            except:
+                self.error = sys.exc_info()
+    
+    c = Dispatch()
+    while c.isAlive():
+        # Pushed back by however long the helper's deadline has been paused.
+        remaining = expires + clock.paused() - paused_before - time.time()
+        if remaining <= 0:
+            raise TimeoutError, 'took too long'
+        c.join(remaining)
+    paused = clock.paused() - paused_before
+    stack = getattr(_deadlines, 'stack', None)
+    if stack and paused:
+        stack[:] = [stack_expires + paused for stack_expires in stack]
+    if c.error:
+        raise c.error[0], c.error[1], c.error[2]
+    return c.result
+
+def deadline_remaining():
+    """Seconds left before the current thread's deadline, or None without one."""
+    stack = getattr(_deadlines, 'stack', None)
+    if stack:
+        return stack[-1] - time.time()
+
+def check_deadline():
+    remaining = deadline_remaining()
+    if remaining is not None and remaining <= 0:
+        raise TimeoutError, 'took too long'
     
 def encode(tstr):
     """ Encodes a unicode string in utf-8
@@ -69,7 +220,94 @@ def levenshtein_distance(first, second):
                 substitution += 1
             distance_matrix[i][j] = min(insertion, deletion, substitution)
     return distance_matrix[first_length-1][second_length-1]
+
+def bounded_levenshtein_distance(first, second, max_distance):
+    """
+    Levenshtein distance, or max_distance + 1 as soon as it's certain to be
+    larger than max_distance. Only the band of cells within max_distance of
+    the diagonal is computed, holding two rows of that band at a time.
+    """
+    if first == second:
+        return 0
+    if len(first) > len(second):
+        first, second = second, first
+    first_length = len(first)
+    second_length = len(second)
+    too_far = max_distance + 1
+    if second_length - first_length > max_distance:
+        return too_far
+    if first_length == 0:
+        return second_length
+    
+    # Cell (i, j) lives at index j - i + max_distance of row i.
+    width = 2 * max_distance + 1
+    previous = [too_far] * width
+    for j in xrange(min(max_distance, second_length) + 1):
+        previous[j + max_distance] = j
     
+    for i in xrange(1, first_length + 1):
+        current = [too_far] * width
+        row_min = too_far
+        first_char = first[i-1]
+        for j in xrange(max(0, i - max_distance), min(second_length, i + max_distance) + 1):
+            index = j - i + max_distance
+            if j == 0:
+                distance = i
+            else:
+                distance = previous[index] + (first_char != second[j-1])
+                if index + 1 < width and previous[index+1] + 1 < distance:
+                    distance = previous[index+1] + 1
+                if index > 0 and current[index-1] + 1 < distance:
+                    distance = current[index-1] + 1
+            if distance > too_far:
+                distance = too_far
+            current[index] = distance
+            if distance < row_min:
+                row_min = distance
+        if row_min >= too_far:
+            return too_far
+        previous = current
+    
+    return previous[second_length - first_length + max_distance]
+    
+
+def content_fingerprint(content):
+    """
+    64-bit simhash over the word trigrams of a story's text, ignoring markup.
+    Near-identical stories get fingerprints only a few bits apart. Returned
+    as a signed int, so it fits in a Mongo long.
+    
+    Texts under MIN_FINGERPRINT_WORDS words get None: with so few trigrams,
+    a one-word edit can move a dozen or more bits, so the distance says too
+    little to skip a comparison on.
+    """
+    if not content:
+        return None
+    words = re.findall(r'\w+', re.sub(r'<[^>]*>', ' ', content).lower(), re.UNICODE)
+    if len(words) < MIN_FINGERPRINT_WORDS:
+        return None
+    
+    shingles = defaultdict(int)
+    for i in xrange(max(1, len(words) - 2)):
+        shingles[u' '.join(words[i:i+3])] += 1
+    
+    vector = [0] * 64
+    for shingle, weight in shingles.iteritems():
+        shingle_hash = int(hashlib.md5(shingle.encode('utf-8')).hexdigest()[:16], 16)
+        for bit in xrange(64):
+            if shingle_hash & (1 << bit):
+                vector[bit] += weight
+            else:
+                vector[bit] -= weight
+    
+    fingerprint = sum(1 << bit for bit in xrange(64) if vector[bit] > 0)
+    if fingerprint >= 1 << 63:
+        fingerprint -= 1 << 64
+    return fingerprint
+
+def fingerprint_distance(first, second):
+    """Hamming distance between two content fingerprints."""
+    return bin((first ^ second) & ((1 << 64) - 1)).count('1')
     
 def fetch_address_from_page(url, existing_feed=None):
     from apps.rss_feeds.models import Feed, DuplicateFeed
@@ -0,0 +1,273 @@
+import datetime
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+from django.db import connection
+from apps.rss_feeds.models import Feed, FeedUpdateHistory, MStory
+from utils.feed_fetcher import FetchFeed, ProcessFeed, FetchPool, Dispatcher
+from utils.feed_fetcher import ENTRY_NEW, ENTRY_UPDATED, ENTRY_SAME, ENTRY_ERR
+from utils.feed_fetcher import FEED_OK, FEED_ERREXC
+from utils.feed_functions import TimeoutError
+from utils import http_pool
+from utils import json_functions as json
+from utils import log as logging
+
+# Fetching feeds as a pipeline of stages, each its own pool of processes:
+#
+#   fetch (network) -> parse (feedparser, story matching) -> write (Mongo) -> post
+#
+# Stages are connected by bounded queues, so a slow stage pushes back on the
+# ones feeding it instead of letting work pile up in memory, and every stage
+# keeps its own counters so it can be sized independently.
+
+class PipelineStage:
+    def __init__(self, name, target, num_workers, queue_size, slots=1):
+        self.name = name
+        self.target = target
+        self.num_workers = num_workers
+        self.slots = num_workers * slots
+        self.queue = multiprocessing.Queue(queue_size)
+        self.next_stage = None
+        self.processed = multiprocessing.Value('i', 0)
+        self.errors = multiprocessing.Value('i', 0)
+        self.busy_seconds = multiprocessing.Value('d', 0.0)
+        self.workers = []
+
+    def start(self):
+        for _ in range(self.num_workers):
+            worker = multiprocessing.Process(target=self.target, args=(self,))
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """Waits for queued jobs to drain through this stage's workers."""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def jobs(self):
+        return iter(self.queue.get, None)
+
+    def done(self, job, busy_seconds):
+        with self.processed.get_lock():
+            self.processed.value += 1
+        with self.busy_seconds.get_lock():
+            self.busy_seconds.value += busy_seconds
+        if job.get('error'):
+            with self.errors.get_lock():
+                self.errors.value += 1
+        if self.next_stage:
+            self.next_stage.queue.put(job)
+
+    def queue_depth(self):
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return -1
+
+    def report(self, seconds_elapsed):
+        seconds_elapsed = max(seconds_elapsed, 1)
+        return {
+            'stage': self.name,
+            'workers': self.num_workers,
+            'processed': self.processed.value,
+            'errors': self.errors.value,
+            'per_second': self.processed.value / float(seconds_elapsed),
+            'utilisation': self.busy_seconds.value / float(seconds_elapsed * self.slots),
+            'queue_depth': self.queue_depth(),
+        }
+
+
+class FeedPipeline:
+    """
+    Runs a batch of feeds through the fetch, parse, write and post-processing
+    stages. Does the same work as `Dispatcher.process_feed_wrapper`, with the
+    stages overlapping across processes instead of running serially per feed.
+    """
+    def __init__(self, options, num_fetchers=1):
+        self.options = options
+        queue_size = options.get('queue_size') or 100
+        fetch_concurrency = max(1, options.get('fetch_concurrency') or 1)
+
+        self.fetch_stage = PipelineStage('fetch', self.fetch_worker, num_fetchers,
+                                         queue_size, slots=fetch_concurrency)
+        self.parse_stage = PipelineStage('parse', self.parse_worker,
+                                         options.get('parsers') or multiprocessing.cpu_count(),
+                                         queue_size)
+        self.write_stage = PipelineStage('write', self.write_worker,
+                                         options.get('writers') or 2, queue_size)
+        self.post_stage = PipelineStage('post', self.post_worker,
+                                        options.get('postprocessors') or 2, queue_size)
+        self.stages = [self.fetch_stage, self.parse_stage, self.write_stage, self.post_stage]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+
+        self.feed_stats = multiprocessing.Array('i', 5)
+        self.entry_stats = multiprocessing.Array('i', 4)
+        self.report_interval = options.get('report_interval') or 60
+        self.time_start = None
+        self.finished = threading.Event()
+
+    def run(self, feed_ids):
+        self.time_start = time.time()
+        # Don't share the parent's database connection with forked workers.
+        connection.close()
+
+        for stage in self.stages:
+            stage.start()
+        reporter = threading.Thread(target=self.report_periodically)
+        reporter.setDaemon(True)
+        reporter.start()
+
+        for feed_id in feed_ids:
+            self.fetch_stage.queue.put(feed_id)
+        for stage in self.stages:
+            stage.stop()
+
+        self.finished.set()
+        self.log_report()
+
+        history = FeedUpdateHistory(
+            number_of_feeds=len(feed_ids),
+            seconds_taken=int(time.time() - self.time_start),
+            worker_utilisation=json.encode(self.report())
+        )
+        history.save()
+
+    def report(self):
+        seconds_elapsed = time.time() - self.time_start
+        return [stage.report(seconds_elapsed) for stage in self.stages]
+
+    def log_report(self):
+        feed_trans = Dispatcher(self.options, 1).feed_trans
+        entry_trans = ProcessFeed(None, None, self.options).entry_trans
+        for stage in self.report():
+            logging.debug(u' ---> [%-5s] %3s workers: %6s done, %3s errors, %6.2f/sec, '
+                          u'%3d%% busy, %4s queued' % (
+                          stage['stage'], stage['workers'], stage['processed'],
+                          stage['errors'], stage['per_second'],
+                          stage['utilisation'] * 100, stage['queue_depth']))
+        logging.debug(u' ---> Feeds: %s / Stories: %s' % (
+                      ' '.join('%s=%s' % (feed_trans[k], v)
+                               for k, v in enumerate(self.feed_stats)),
+                      ' '.join('%s=%s' % (entry_trans[k], v)
+                               for k, v in enumerate(self.entry_stats))))
+
+    def report_periodically(self):
+        while not self.finished.wait(self.report_interval):
+            self.log_report()
+
+    # ==========
+    # = Stages =
+    # ==========
+
+    def fetch_worker(self, stage):
+        fetch_concurrency = max(1, self.options.get('fetch_concurrency') or 1)
+        fetch_pool = FetchPool(self.options, fetch_concurrency, download_only=True)
+
+        for feed_id, fetch_result, fetch_error, fetch_start in fetch_pool.fetch(stage.jobs()):
+            job = {
+                'feed_id': feed_id,
+                'start_time': fetch_start,
+                'ret_feed': FEED_ERREXC,
+                'ret_entries': {},
+                'fetched': False,
+            }
+            if fetch_error:
+                self.record_error(job, fetch_error)
+            else:
+                job['ret_feed'], job['response'] = fetch_result
+                job['fetched'] = True
+            stage.done(job, self.seconds_since(fetch_start))
+        http_pool.pool.log_stats()
+
+    def parse_worker(self, stage):
+        def parse(job):
+            fpf = FetchFeed.parse(job.pop('response'))
+            pfeed = ProcessFeed(job['feed_id'], fpf, self.options)
+            job['ret_feed'], job['story_writes'] = pfeed.match()
+            job['processed'] = True
+        self.run_stage(stage, parse, skip_errors=True)
+
+    def write_worker(self, stage):
+        def write(job):
+            story_writes = job.pop('story_writes', None)
+            if job['ret_feed'] != FEED_OK:
+                return
+            pfeed = ProcessFeed(job['feed_id'], None, self.options)
+            pfeed.refresh_feed()
+            job['ret_entries'] = pfeed.feed.write_stories(story_writes)
+            job['new_story_ids'] = [story.id for story in pfeed.feed.new_stories]
+            pfeed.log_entries(job['ret_entries'])
+        self.run_stage(stage, write, skip_errors=True)
+
+    def post_worker(self, stage):
+        dispatcher = Dispatcher(self.options, 1)
+        identity = multiprocessing.current_process()._identity[0]
+
+        def post_process(job):
+            feed_id = job['feed_id']
+            if job.get('gone'):
+                logging.debug('   ---> [%-30s] Feed is now gone...' % (unicode(feed_id)[:30]))
+                return
+            if job.get('error'):
+                Feed.objects.get(pk=feed_id).save_feed_history(*job['error'])
+            elif job['ret_feed'] == FEED_OK:
+                pfeed = ProcessFeed(feed_id, None, self.options)
+                pfeed.refresh_feed()
+                pfeed.finish()
+            new_stories = None
+            if job.get('processed') and not job.get('error'):
+                new_story_ids = job.get('new_story_ids')
+                new_stories = new_story_ids and list(MStory.objects(id__in=new_story_ids))
+                dispatcher.update_subscribers(feed_id, job['ret_entries'], new_stories)
+
+            ret_entries = dict((key, job['ret_entries'].get(key, 0)) for key in
+                               (ENTRY_NEW, ENTRY_UPDATED, ENTRY_SAME, ENTRY_ERR))
+            dispatcher.fetch_page(feed_id, job['ret_feed'], job['fetched'])
+            dispatcher.finish_feed(feed_id, job['ret_feed'], ret_entries,
+                                   job['start_time'], identity, new_stories)
+
+            with self.feed_stats.get_lock():
+                self.feed_stats[job['ret_feed']] += 1
+            with self.entry_stats.get_lock():
+                for key, val in ret_entries.items():
+                    self.entry_stats[key] += val
+        self.run_stage(stage, post_process)
+
+    def run_stage(self, stage, handler, skip_errors=False):
+        for job in stage.jobs():
+            start = datetime.datetime.utcnow()
+            if not (skip_errors and (job.get('error') or job.get('gone'))):
+                try:
+                    handler(job)
+                except Exception:
+                    self.record_error(job)
+            stage.done(job, self.seconds_since(start))
+
+    def record_error(self, job, exc_info=None):
+        exc_info = exc_info or sys.exc_info()
+        exc_type = exc_info[0]
+        tb = ''.join(traceback.format_exception(*exc_info))
+
+        job['ret_feed'] = FEED_ERREXC
+        job['fetched'] = False
+        job.pop('response', None)
+        job.pop('story_writes', None)
+        if issubclass(exc_type, Feed.DoesNotExist):
+            job['gone'] = True
+        elif issubclass(exc_type, TimeoutError):
+            logging.debug('   ---> [%-30s] Feed fetch timed out...' % (unicode(job['feed_id'])[:30]))
+            job['error'] = (505, 'Timeout', None)
+        else:
+            logging.debug('[%d] ! -------------------------' % (job['feed_id'],))
+            logging.error(tb)
+            logging.debug('[%d] ! -------------------------' % (job['feed_id'],))
+            job['error'] = (500, 'Error', tb)
+
+    def seconds_since(self, start):
+        delta = datetime.datetime.utcnow() - start
+        return delta.seconds + delta.microseconds / 1000000.0
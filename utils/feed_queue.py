@@ -0,0 +1,171 @@
+import datetime
+import heapq
+import mongoengine as mongo
+import pymongo
+from django.conf import settings
+
+# How long a feed handed out by pop_due stays claimed. Fetching it
+# reschedules it sooner, so this only matters when a fetch never finishes.
+FEED_LEASE_MINUTES = 60
+# Not a feed id. Marks a queue that has been filled with every fetchable feed.
+FILLED_MARKER_ID = -1
+# Feeds inserted per write when filling the queue.
+FILL_BATCH_SIZE = 1000
+
+class LocalFeedQueue(object):
+    """
+    Feeds ordered by when they're next due, in a heap in this process. Stands
+    in for the shared FeedQueue in tests and single-process setups.
+
+    Rescheduling a feed leaves its old entry in the heap, and pop_due skips
+    entries that no longer match the feed's due date.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.due_dates = {}
+        self.filled = False
+
+    def __len__(self):
+        return len(self.due_dates)
+
+    def is_filled(self):
+        return self.filled
+
+    def fill(self, due_dates):
+        """
+        Adds the feeds that aren't queued yet, leaving those that are alone,
+        and marks the queue filled.
+        """
+        self.schedule(dict((feed_id, due_date) for feed_id, due_date in due_dates.items()
+                           if feed_id not in self.due_dates))
+        self.filled = True
+
+    def schedule(self, due_dates):
+        """Takes a dict of feed id to due date."""
+        for feed_id, due_date in due_dates.items():
+            self.due_dates[feed_id] = due_date
+            heapq.heappush(self.heap, (due_date, feed_id))
+        if len(self.heap) > 2 * len(self.due_dates) + 1000:
+            self.heap = [(due_date, feed_id) for feed_id, due_date in self.due_dates.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, feed_ids):
+        for feed_id in feed_ids:
+            self.due_dates.pop(feed_id, None)
+
+    def pop_due(self, now, limit):
+        """
+        Returns up to `limit` feed ids due by `now`, soonest first, and
+        leases them for FEED_LEASE_MINUTES.
+        """
+        feed_ids = []
+        while self.heap and len(feed_ids) < limit and self.heap[0][0] <= now:
+            due_date, feed_id = heapq.heappop(self.heap)
+            if self.due_dates.get(feed_id) == due_date:
+                feed_ids.append(feed_id)
+        lease = now + datetime.timedelta(minutes=FEED_LEASE_MINUTES)
+        self.schedule(dict((feed_id, lease) for feed_id in feed_ids))
+        return feed_ids
+
+
+class MFeedQueue(mongo.Document):
+    feed_id = mongo.IntField(primary_key=True)
+    due_date = mongo.DateTimeField()
+
+    meta = {
+        'collection': 'feed_queue',
+        'allow_inheritance': False,
+        'indexes': ['due_date'],
+    }
+
+
+class FeedQueue(object):
+    """
+    Feeds ordered by when they're next due, kept in a collection indexed on
+    the due date so every process shares it. Popping the next due feeds is
+    an index range read, instead of a scan and random sort of the feeds table.
+    """
+
+    def __init__(self):
+        self.collection = MFeedQueue.objects._collection
+
+    def __len__(self):
+        return self.collection.find({'due_date': {'$exists': True}}).count()
+
+    def is_filled(self):
+        return bool(self.collection.find_one({'_id': FILLED_MARKER_ID}))
+
+    def fill(self, due_dates):
+        """
+        Adds the feeds that aren't queued yet, leaving those that are (and
+        their leases) alone, and marks the queue filled. Inserts in batches
+        of FILL_BATCH_SIZE.
+        """
+        queued_ids = set(doc['_id'] for doc in self.collection.find({}, ['_id']))
+        docs = [{'_id': feed_id, 'due_date': due_date} for feed_id, due_date in due_dates.items()
+                if feed_id not in queued_ids]
+        for i in range(0, len(docs), FILL_BATCH_SIZE):
+            batch = docs[i:i+FILL_BATCH_SIZE]
+            try:
+                self.collection.insert(batch, safe=True)
+            except pymongo.errors.OperationFailure:
+                # Something queued one of these since. The batch stopped at
+                # it, so insert the rest one at a time.
+                for doc in batch:
+                    try:
+                        self.collection.insert(doc, safe=True)
+                    except pymongo.errors.OperationFailure:
+                        pass
+        self.collection.save({'_id': FILLED_MARKER_ID}, safe=True)
+
+    def schedule(self, due_dates):
+        """Takes a dict of feed id to due date."""
+        for feed_id, due_date in due_dates.items():
+            self.collection.update({'_id': feed_id}, {'$set': {'due_date': due_date}}, upsert=True)
+
+    def remove(self, feed_ids):
+        if feed_ids:
+            self.collection.remove({'_id': {'$in': list(feed_ids)}})
+
+    def pop_due(self, now, limit):
+        """
+        Returns up to `limit` feed ids due by `now`, soonest first, and
+        leases them for FEED_LEASE_MINUTES. Three round trips however many
+        feeds are due, and overlapping pops never hand out the same feed twice.
+        """
+        lease = now + datetime.timedelta(minutes=FEED_LEASE_MINUTES)
+        due_feeds = self.collection.find({'due_date': {'$lte': now}}, ['_id'])\
+                                   .sort('due_date', 1).limit(limit)
+        feed_ids = [doc['_id'] for doc in due_feeds]
+        claimed_ids = self.claim(feed_ids, now, lease)
+        return [feed_id for feed_id in feed_ids if feed_id in claimed_ids]
+
+    def claim(self, feed_ids, now, lease):
+        """
+        Leases those of the feeds that are still due in one update, tagging
+        them with a token only this claim knows, and reads back the ones it
+        tagged. Feeds another pop leased first are no longer due, so only
+        one of two racing pops gets each feed. Returns the set claimed.
+        """
+        if not feed_ids:
+            return set()
+        token = pymongo.objectid.ObjectId()
+        self.collection.update({'_id': {'$in': feed_ids}, 'due_date': {'$lte': now}},
+                               {'$set': {'due_date': lease, 'lease': token}},
+                               multi=True, safe=True)
+        claimed = self.collection.find({'_id': {'$in': feed_ids}, 'lease': token}, ['_id'])
+        return set(doc['_id'] for doc in claimed)
+
+
+_feed_queue = None
+
+def get_feed_queue():
+    """The queue set by settings.FEED_QUEUE_BACKEND, 'mongo' (the default) or 'local'."""
+    global _feed_queue
+    if _feed_queue is None:
+        if getattr(settings, 'FEED_QUEUE_BACKEND', 'mongo') == 'local':
+            _feed_queue = LocalFeedQueue()
+        else:
+            _feed_queue = FeedQueue()
+    return _feed_queue
@@ -0,0 +1,214 @@
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urllib2
+from StringIO import StringIO
+from utils import log as logging
+from utils.feed_functions import deadline_remaining, check_deadline, pause_deadline
+
+# Keep-alive connections and a politeness limit per host, shared by every
+# feed and page fetch in a process. Thousands of our feeds live on a handful
+# of hosts (feedburner, blogspot, tumblr), so reusing their connections saves
+# a TCP/TLS handshake per fetch, and capping how hard we hit any one host
+# keeps us from getting throttled by it.
+
+MAX_CONNECTIONS_PER_HOST = 4
+MIN_SECONDS_BETWEEN_REQUESTS = 0.1
+MAX_IDLE_SECONDS = 15
+
+
+class HostPool:
+    def __init__(self, host, max_connections, min_interval):
+        self.host = host
+        self.min_interval = min_interval
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.next_request = 0
+        self.requests = 0
+        self.reused = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+
+    def acquire(self):
+        """
+        Waits for one of the host's connection slots and for the host's
+        minimum interval between requests. Returns the seconds spent waiting.
+        The slot is given back if anything interrupts the wait after it's taken.
+        """
+        wait_start = time.time()
+        if not self.slots.acquire(False):
+            self.slots.acquire()
+        try:
+            with self.lock:
+                now = time.time()
+                request_at = max(now, self.next_request)
+                self.next_request = request_at + self.min_interval
+            if request_at > now:
+                time.sleep(request_at - now)
+        except:
+            self.slots.release()
+            raise
+
+        waited = time.time() - wait_start
+        with self.lock:
+            self.requests += 1
+            if waited > 0.001:
+                self.throttled += 1
+                self.throttled_seconds += waited
+        return waited
+
+    def release(self):
+        self.slots.release()
+
+    def get_connection(self, http_class, timeout):
+        """Returns (connection, reused), preferring a recently used idle one."""
+        with self.lock:
+            while self.idle:
+                conn, last_used = self.idle.pop()
+                if time.time() - last_used < MAX_IDLE_SECONDS:
+                    self.reused += 1
+                    conn.timeout = timeout
+                    if conn.sock:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return http_class(self.host, timeout=timeout), False
+
+    def put_connection(self, conn):
+        with self.lock:
+            self.idle.append((conn, time.time()))
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'reused': self.reused,
+            'reuse_ratio': self.reused / float(max(1, self.requests)),
+            'throttled': self.throttled,
+            'throttled_seconds': self.throttled_seconds,
+        }
+
+
+class ConnectionPool:
+    def __init__(self, max_connections=MAX_CONNECTIONS_PER_HOST,
+                 min_interval=MIN_SECONDS_BETWEEN_REQUESTS):
+        self.max_connections = max_connections
+        self.min_interval = min_interval
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, scheme, host):
+        key = (scheme, host.lower())
+        with self.lock:
+            if key not in self.hosts:
+                self.hosts[key] = HostPool(host, self.max_connections, self.min_interval)
+            return self.hosts[key]
+
+    def stats(self):
+        with self.lock:
+            hosts = self.hosts.items()
+        return dict(('%s://%s' % key, host_pool.stats()) for key, host_pool in hosts)
+
+    def log_stats(self, limit=10):
+        stats = sorted(self.stats().items(), key=lambda (host, s): -s['requests'])
+        for host, s in stats[:limit]:
+            logging.debug(u' ---> [%-30s] %4s requests, %3d%% reused, %3s throttled (%.1fs)' % (
+                          host[:30], s['requests'], s['reuse_ratio'] * 100,
+                          s['throttled'], s['throttled_seconds']))
+
+
+class KeepAliveMixin:
+    """
+    Replaces urllib2's one-connection-per-request do_open. The response body
+    is read in full so the connection can go straight back to its host's
+    pool, which is fine since every caller reads the whole feed or page.
+    """
+    def do_open(self, http_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        host_pool = self.pool.host(req.get_type(), host)
+        # Waiting our turn at a busy host isn't the feed being slow, so it
+        # doesn't count against the fetch's time limit.
+        with pause_deadline():
+            host_pool.acquire()
+        try:
+            conn, reused = host_pool.get_connection(http_class, self.timeout(req))
+            while True:
+                try:
+                    r, body = self.request(conn, req)
+                    break
+                except (socket.error, httplib.HTTPException), e:
+                    conn.close()
+                    check_deadline()
+                    if not reused:
+                        raise urllib2.URLError(e)
+                    # The server dropped the idle connection, so retry once on a fresh one.
+                    conn, reused = http_class(host, timeout=self.timeout(req)), False
+                except:
+                    conn.close()
+                    raise
+        finally:
+            host_pool.release()
+
+        if r.will_close:
+            conn.close()
+        else:
+            host_pool.put_connection(conn)
+
+        resp = urllib.addinfourl(StringIO(body), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+    def timeout(self, req):
+        """The request's socket timeout, cut down to the thread's deadline."""
+        timeout = req.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        remaining = deadline_remaining()
+        if remaining is not None:
+            check_deadline()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def request(self, conn, req):
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers = dict((name.title(), val) for name, val in headers.items())
+        headers.pop('Connection', None)
+
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        r = conn.getresponse()
+        return r, r.read()
+
+
+class KeepAliveHTTPHandler(KeepAliveMixin, urllib2.HTTPHandler):
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.do_open(httplib.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, urllib2.HTTPSHandler):
+    def __init__(self, pool):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self.do_open(httplib.HTTPSConnection, req)
+
+
+pool = ConnectionPool()
+
+def handlers():
+    """urllib2 handlers that route http and https through the shared pool."""
+    return [KeepAliveHTTPHandler(pool), KeepAliveHTTPSHandler(pool)]
+
+def urlopen(request):
+    return urllib2.build_opener(*handlers()).open(request)
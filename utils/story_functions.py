@@ -1,6 +1,10 @@
 from django.utils.dateformat import DateFormat
 import datetime
+import pymongo
 from django.utils.http import urlquote
+from mongoengine.queryset import Q
+
+EPOCH = datetime.datetime(1970, 1, 1)
 
 def format_story_link_date__short(date):
     parsed_date, date_tuple, today_tuple, yesterday_tuple = _extract_date_tuples(date)
@@ -31,6 +35,41 @@ def _extract_date_tuples(date):
     
     return parsed_date, date_tuple, today_tuple, yesterday_tuple
     
+def milliseconds_since_epoch(date):
+    # Mongo keeps dates to the millisecond, so this is exact for stored stories.
+    delta = date - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+def encode_story_cursor(date, story_id):
+    """
+    A page position: the date and id of the last story on the page before.
+    Stories are ordered by date then id, newest first.
+    """
+    return '%s:%s' % (milliseconds_since_epoch(date), story_id)
+
+def decode_story_cursor(cursor):
+    """Returns (date, story id), or None for the first page and bad cursors."""
+    if not cursor:
+        return None
+    try:
+        milliseconds, story_id = cursor.split(':')
+        date = EPOCH + datetime.timedelta(milliseconds=int(milliseconds))
+        return date, pymongo.objectid.ObjectId(story_id)
+    except (ValueError, TypeError, pymongo.errors.InvalidId):
+        return None
+
+def stories_after_cursor(stories, cursor, date_field='story_date'):
+    """
+    Orders a story queryset newest first, starting after `cursor`. This is
+    keyset pagination, so deep pages cost no more than the first.
+    """
+    position = decode_story_cursor(cursor)
+    if position:
+        date, story_id = position
+        stories = stories.filter(Q(**{date_field + '__lt': date}) | 
+                                 Q(**{date_field: date, 'id__lt': story_id}))
+    return stories.order_by('-' + date_field, '-id')
+    
 def pre_process_story(entry):
     publish_date = entry.get('published_parsed', entry.get('updated_parsed'))
     entry['published'] = datetime.datetime(*publish_date[:6]) if publish_date else datetime.datetime.utcnow()